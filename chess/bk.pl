@@ -56,28 +56,54 @@ move(FromX,FromY,ToX,ToY) :-
     square(FromX,FromY),
     square(ToX,ToY).
 
+% a position is either a list of contents/4, turn/1 and castling terms, or the integer ID it was interned under
+:- dynamic interned_position/2.
+:- dynamic interned_legal_move/3.
+
 position(Pos) :- 
     % how to indicate list of contents/4 predicates?
     is_list(Pos).
+position(Pos) :-
+    integer(Pos),
+    interned_position(Pos, _).
+
+position_list(Pos, List) :-
+    integer(Pos), !,
+    interned_position(Pos, List).
+position_list(Pos, Pos).
 
 turn(Side, Pos) :-
     side(Side),
-    member(turn(Side), Pos).
+    position_list(Pos, List),
+    member(turn(Side), List).
 
 kingside_castle(Side, Pos) :-
-    member(kingside_castle(Side), Pos).
+    position_list(Pos, List),
+    member(kingside_castle(Side), List).
 queenside_castle(Side, Pos) :-
-    member(queenside_castle(Side), Pos).
+    position_list(Pos, List),
+    member(queenside_castle(Side), List).
 
 %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
 :- dynamic legal_move/3.
 
+% relations precomputed for an interned position, with the rules below as the fallback for every other position
+:- dynamic materialised/1.
+:- dynamic materialised_attacks/3.
+:- dynamic materialised_piece_at/4.
+:- dynamic materialised_behind/4.
+
+attacks(From,To,Pos) :-
+    integer(Pos),
+    materialised(Pos), !,
+    materialised_attacks(Pos, From, To).
 attacks(From,To,Pos) :-
     to_coords(From, FromX, FromY),
     to_coords(To, ToX, ToY),
-    member(contents(Side,_,FromX,FromY), Pos),
-    member(contents(OtherSide,_,ToX,ToY), Pos),
+    position_list(Pos, List),
+    member(contents(Side,_,FromX,FromY), List),
+    member(contents(OtherSide,_,ToX,ToY), List),
     other_side(Side, OtherSide),
     legal_move(From, To, Pos).
 
@@ -87,10 +113,19 @@ different_pos(S1, S2) :-
     S1 \== S2.
 % different_pos(S1, S2) :- different_pos(S2, S1).
 
+piece_at(S, Pos, Side, Piece) :-
+    integer(Pos),
+    materialised(Pos), !,
+    materialised_piece_at(Pos, S, Side, Piece).
 piece_at(S, Pos, Side, Piece) :-
     to_coords(S, X, Y),
-    member(contents(Side, Piece, X, Y), Pos).
+    position_list(Pos, List),
+    member(contents(Side, Piece, X, Y), List).
 
+behind(Front, Middle, Back, Pos) :-
+    integer(Pos),
+    materialised(Pos), !,
+    materialised_behind(Pos, Front, Middle, Back).
 behind(Front, Middle, Back, Pos) :-
     attacks(Front, Middle, Pos),
     attacks(Front, Back, Pos),
@@ -109,13 +144,25 @@ behind(Front, Middle, Back, Pos) :-
 %     member(contents(_,Piece,FromX,FromY),Pos), % piece to be moved exists
 %     can_move(Piece,FromX,FromY,ToX,ToY). % move for the piece is theoretically permitted (if board was empty)
     
+% successor positions precomputed for an interned position, with the rule below as the fallback for every other position
+:- dynamic interned_successors/1.
+:- dynamic interned_successor/4.
+
+make_move(From, To, Pos, NewPos) :-
+    integer(Pos),
+    interned_successors(Pos), !,
+    \+ ground(NewPos),
+    interned_successor(Pos, From, To, NewPos).
 make_move(From, To, Pos, NewPos) :-
     \+ ground(NewPos),
     to_coords(From, FromX, FromY),
     to_coords(To, ToX, ToY),
     legal_move(From, To, Pos),
-    member(contents(Side,Piece,FromX,FromY),Pos),
-    delete(Pos, contents(Side,Piece,FromX,FromY), TmpPos),
+    position_list(Pos, List),
+    member(contents(Side,Piece,FromX,FromY),List),
+    delete(List, contents(Side,Piece,FromX,FromY), MovedPos),
+    % a captured piece leaves the board
+    delete(MovedPos, contents(_,_,ToX,ToY), TmpPos),
     append(TmpPos, [contents(Side, Piece, ToX, ToY)], TmpNewUnsortedPos),
     (
         ground(NewPos) ->
@@ -0,0 +1,147 @@
+% Background knowledge over a bitboard position:
+%   board(Turn, Castling, WhitePawns, WhiteKnights, WhiteBishops, WhiteRooks, WhiteQueens, WhiteKing,
+%         BlackPawns, BlackKnights, BlackBishops, BlackRooks, BlackQueens, BlackKing)
+% Square a1 is bit 0 and h8 is bit 63, as in python-chess. Every bitboard is kept as a signed 64-bit integer so that
+% it fits a C long when it crosses into Python. Castling has bit 0 for white kingside, 1 for white queenside, 2 for
+% black kingside and 3 for black queenside.
+
+% listed in the same order as to_coords/3 in bk.pl, so squares are enumerated in the same order
+sq_index(a1, 0). sq_index(a2, 8). sq_index(a3, 16). sq_index(a4, 24). sq_index(a5, 32). sq_index(a6, 40). sq_index(a7, 48). sq_index(a8, 56).
+sq_index(b1, 1). sq_index(b2, 9). sq_index(b3, 17). sq_index(b4, 25). sq_index(b5, 33). sq_index(b6, 41). sq_index(b7, 49). sq_index(b8, 57).
+sq_index(c1, 2). sq_index(c2, 10). sq_index(c3, 18). sq_index(c4, 26). sq_index(c5, 34). sq_index(c6, 42). sq_index(c7, 50). sq_index(c8, 58).
+sq_index(d1, 3). sq_index(d2, 11). sq_index(d3, 19). sq_index(d4, 27). sq_index(d5, 35). sq_index(d6, 43). sq_index(d7, 51). sq_index(d8, 59).
+sq_index(e1, 4). sq_index(e2, 12). sq_index(e3, 20). sq_index(e4, 28). sq_index(e5, 36). sq_index(e6, 44). sq_index(e7, 52). sq_index(e8, 60).
+sq_index(f1, 5). sq_index(f2, 13). sq_index(f3, 21). sq_index(f4, 29). sq_index(f5, 37). sq_index(f6, 45). sq_index(f7, 53). sq_index(f8, 61).
+sq_index(g1, 6). sq_index(g2, 14). sq_index(g3, 22). sq_index(g4, 30). sq_index(g5, 38). sq_index(g6, 46). sq_index(g7, 54). sq_index(g8, 62).
+sq_index(h1, 7). sq_index(h2, 15). sq_index(h3, 23). sq_index(h4, 31). sq_index(h5, 39). sq_index(h6, 47). sq_index(h7, 55). sq_index(h8, 63).
+
+sq(a1). sq(a2). sq(a3). sq(a4). sq(a5). sq(a6). sq(a7). sq(a8).
+sq(b1). sq(b2). sq(b3). sq(b4). sq(b5). sq(b6). sq(b7). sq(b8).
+sq(c1). sq(c2). sq(c3). sq(c4). sq(c5). sq(c6). sq(c7). sq(c8).
+sq(d1). sq(d2). sq(d3). sq(d4). sq(d5). sq(d6). sq(d7). sq(d8).
+sq(e1). sq(e2). sq(e3). sq(e4). sq(e5). sq(e6). sq(e7). sq(e8).
+sq(f1). sq(f2). sq(f3). sq(f4). sq(f5). sq(f6). sq(f7). sq(f8).
+sq(g1). sq(g2). sq(g3). sq(g4). sq(g5). sq(g6). sq(g7). sq(g8).
+sq(h1). sq(h2). sq(h3). sq(h4). sq(h5). sq(h6). sq(h7). sq(h8).
+
+bb_arg(white, pawn, 3).
+bb_arg(white, knight, 4).
+bb_arg(white, bishop, 5).
+bb_arg(white, rook, 6).
+bb_arg(white, queen, 7).
+bb_arg(white, king, 8).
+bb_arg(black, pawn, 9).
+bb_arg(black, knight, 10).
+bb_arg(black, bishop, 11).
+bb_arg(black, rook, 12).
+bb_arg(black, queen, 13).
+bb_arg(black, king, 14).
+
+castle_bit(white, kingside, 0).
+castle_bit(white, queenside, 1).
+castle_bit(black, kingside, 2).
+castle_bit(black, queenside, 3).
+
+side(white).
+side(black).
+other_side(white, black).
+other_side(black, white).
+
+piece(Piece) :-
+    member(Piece, [pawn, knight, bishop, rook, queen, king]).
+
+sliding_piece(Piece) :-
+    piece(Piece),
+    member(Piece, [bishop, rook, queen]).
+
+position(Pos) :-
+    functor(Pos, board, 14).
+
+turn(Side, Pos) :-
+    arg(1, Pos, Side).
+
+kingside_castle(Side, Pos) :-
+    castle_bit(Side, kingside, I),
+    arg(2, Pos, Castling),
+    Castling >> I /\ 1 =:= 1.
+queenside_castle(Side, Pos) :-
+    castle_bit(Side, queenside, I),
+    arg(2, Pos, Castling),
+    Castling >> I /\ 1 =:= 1.
+
+% wrap an unbounded integer back into the signed 64-bit range
+int64(X, Y) :-
+    Y is ((X + 9223372036854775808) mod 18446744073709551616) - 9223372036854775808.
+
+occupied(I, Pos, Side, Piece) :-
+    bb_arg(Side, Piece, A),
+    arg(A, Pos, BB),
+    BB >> I /\ 1 =:= 1.
+
+side_at(I, Pos, Side) :-
+    side(Side),
+    once(occupied(I, Pos, Side, _)).
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+:- dynamic legal_move/3.
+
+attacks(From,To,Pos) :-
+    sq_index(From, FromI),
+    sq_index(To, ToI),
+    side_at(FromI, Pos, Side),
+    side_at(ToI, Pos, OtherSide),
+    other_side(Side, OtherSide),
+    legal_move(From, To, Pos).
+
+different_pos(S1, S2) :-
+    sq(S1),
+    sq(S2),
+    S1 \== S2.
+
+piece_at(S, Pos, Side, Piece) :-
+    sq_index(S, I),
+    occupied(I, Pos, Side, Piece).
+
+behind(Front, Middle, Back, Pos) :-
+    attacks(Front, Middle, Pos),
+    attacks(Front, Back, Pos),
+    piece_at(Front, Pos, _, Piece),
+    sliding_piece(Piece).
+
+clear_square(I, BB, NewBB) :-
+    int64(BB /\ \ (1 << I), NewBB).
+
+% like the list version, a captured piece leaves the board and the turn does not change
+make_move(From, To, Pos, NewPos) :-
+    \+ ground(NewPos),
+    sq_index(From, FromI),
+    sq_index(To, ToI),
+    legal_move(From, To, Pos),
+    bb_arg(_, _, A),
+    arg(A, Pos, BB),
+    BB >> FromI /\ 1 =:= 1,
+    Pos =.. [board, Turn, Castling|BBs],
+    maplist(clear_square(ToI), BBs, ClearedBBs),
+    I is A - 2,
+    nth1(I, ClearedBBs, Moving, Rest),
+    int64((Moving /\ \ (1 << FromI)) \/ (1 << ToI), Moved),
+    nth1(I, NewBBs, Moved, Rest),
+    NewPos =.. [board, Turn, Castling|NewBBs].
+
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+pin(Pos, From, To) :-
+    make_move(From, To, Pos, NewPos),
+    behind(To, Middle, Back, NewPos),
+    piece_at(To, NewPos, SameSide, _),
+    piece_at(Middle, NewPos, OppSide, _),
+    piece_at(Back, NewPos, OppSide, _),
+    different_pos(Middle, Back),
+    other_side(SameSide, OppSide).
+
+fork(Pos, From, To) :-
+    make_move(From, To, Pos, NewPos),
+    attacks(To, S1, NewPos),
+    attacks(To, S2, NewPos),
+    different_pos(S1, S2).
@@ -1,4 +1,5 @@
 import os
+import pickle
 import re
 import sys
 import clingo
@@ -24,9 +25,34 @@ def atom_to_symbol(pred, args):
     xs = tuple(arg_to_symbol(arg) for arg in args)
     return Function(name = pred, arguments = xs)
 
+def distinct_assignments(domains):
+    "Every way of giving each variable a different value from its domain"
+    if not domains:
+        yield ()
+        return
+    first, rest = domains[0], domains[1:]
+    for value in first:
+        for values in distinct_assignments([[x for x in domain if x != value] for domain in rest]):
+            yield (value,) + values
+
 class ClingoGrounder():
-    def __init__(self):
+    def __init__(self, cache_file=None):
         self.seen_assignments = {}
+        self.cache_file = cache_file
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                self.seen_assignments = pickle.load(f)
+        self.cache_hits = 0
+        self.native_calls = 0
+        self.clingo_calls = 0
+
+    def save(self):
+        if self.cache_file:
+            with open(self.cache_file, 'wb') as f:
+                pickle.dump(self.seen_assignments, f)
+
+    def counters(self):
+        return {'grounding cache hits': self.cache_hits, 'native groundings': self.native_calls, 'clingo groundings': self.clingo_calls}
 
     def find_bindings(self, clause, max_clauses, max_vars):
         (_, body) = clause
@@ -34,10 +60,61 @@ class ClingoGrounder():
         if len(all_vars) == 0:
             return [{}]
 
-        k = Grounding.grounding_hash(body, all_vars)
+        k = Grounding.grounding_key(body, all_vars, max_clauses, max_vars)
         if k in self.seen_assignments:
+            self.cache_hits += 1
             return self.seen_assignments[k]
 
+        out = self.native_bindings(body, all_vars, max_clauses, max_vars)
+        if out is None:
+            self.clingo_calls += 1
+            out = self.clingo_bindings(body, all_vars, max_clauses, max_vars)
+        else:
+            self.native_calls += 1
+        self.seen_assignments[k] = out
+        return out
+
+    def native_bindings(self, body, all_vars, max_clauses, max_vars):
+        "Enumerates the bindings without clingo, or returns None if the body has a side condition it does not handle"
+        fixed = {}
+        lower = {}
+        less = []
+        for lit in body:
+            if not lit.meta or lit.predicate == 'AllDifferent':
+                continue
+            args = lit.arguments
+            if lit.predicate == '==' and args[0] in all_vars and args[0].type == 'Variable' and isinstance(args[1], int):
+                if fixed.get(args[0], args[1]) != args[1]:
+                    return []
+                fixed[args[0]] = args[1]
+            elif lit.predicate == '>=' and args[0] in all_vars and args[0].type == 'Clause' and isinstance(args[1], int):
+                lower[args[0]] = max(lower.get(args[0], 0), args[1])
+            elif lit.predicate == '<' and all(arg in all_vars and arg.type == 'Clause' for arg in args):
+                less.append(args)
+            else:
+                return None
+
+        # the most constrained variables go first, so that dead ends are cut early
+        c_vars = sorted((var for var in all_vars if var.type == 'Clause'), key=lambda var: -lower.get(var, 0))
+        v_vars = sorted((var for var in all_vars if var.type == 'Variable'), key=lambda var: var not in fixed)
+        c_domains = [range(lower.get(var, 0), max_clauses) for var in c_vars]
+        v_domains = [[fixed[var]] if var in fixed else range(max_vars) for var in v_vars]
+        if any(not 0 <= value < max_vars for value in fixed.values()):
+            return []
+
+        c_assignments = []
+        for values in distinct_assignments(c_domains):
+            assignment = dict(zip(c_vars, values))
+            if all(assignment[var1] < assignment[var2] for var1, var2 in less):
+                c_assignments.append(assignment)
+        out = []
+        for values in distinct_assignments(v_domains):
+            v_assignment = dict(zip(v_vars, values))
+            for c_assignment in c_assignments:
+                out.append({**c_assignment, **v_assignment})
+        return out
+
+    def clingo_bindings(self, body, all_vars, max_clauses, max_vars):
         # map each clause_var and var_var in the program to an integer
         c_vars = {v:i for i,v in enumerate(var for var in all_vars if var.type == 'Clause')}
         v_vars = {v:i for i,v in enumerate(var for var in all_vars if var.type == 'Variable')}
@@ -110,7 +187,6 @@ class ClingoGrounder():
             out.append(assignment)
 
         solver.solve(on_model=on_model)
-        self.seen_assignments[k] = out
         return out
 
 class ClingoSolver():
@@ -158,6 +234,28 @@ class ClingoSolver():
         self.max_vars = next(max_vars_atoms).symbol.arguments[0].number
         max_clauses_atoms = self.solver.symbolic_atoms.by_signature('max_clauses', arity=1)
         self.max_clauses = next(max_clauses_atoms).symbol.arguments[0].number
+        max_body_atoms = self.solver.symbolic_atoms.by_signature('max_body', arity=1)
+        self.max_body = next(max_body_atoms).symbol.arguments[0].number
+        # the largest program the bias allows, in literals, every clause being a head and at most max_body body literals
+        self.max_size = self.max_clauses * (self.max_body + 1)
+
+    def restrict_to_partition(self, k, num_partitions):
+        "Only generates the programs of the k-th of `num_partitions` partitions of the hypothesis space"
+        # a program belongs to the pair of its first two body literals, in the order below, and the pairs are dealt out
+        # in turn, so every partition gets a share of the programs that start with each literal
+        literals = sorted({(atom.symbol.arguments[1], atom.symbol.arguments[3]) for atom in self.solver.symbolic_atoms.by_signature('body_literal', arity=4)})
+        rules = [f'part_index({pred},{args},{i}).' for i, (pred, args) in enumerate(literals)]
+        rules.append(f"""
+        part_literal(I):- body_literal(_,P,_,Vars), part_index(P,Vars,I).
+        part_first(I):- part_literal(I), #count{{J : part_literal(J), J < I}} == 0.
+        part_second(I):- part_literal(I), #count{{J : part_literal(J), J < I}} == 1.
+        % a program with a single body literal has the number of literals as its second
+        part_pair(F,S):- part_first(F), part_second(S).
+        part_pair(F,{len(literals)}):- part_first(F), not part_second(_).
+        :- part_pair(F,S), (F * {len(literals) + 1} + S) \\ {num_partitions} != {k}.
+        """)
+        self.solver.add('partition', [], '\n'.join(rules))
+        self.solver.ground([('partition', [])])
 
     def get_model(self):
         with self.solver.solve(yield_ = True) as handle:
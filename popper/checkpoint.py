@@ -0,0 +1,46 @@
+import os
+import pickle
+from time import perf_counter
+
+class Checkpoint:
+    "Saves the state of the search to a file every so often, so that an interrupted run can be resumed"
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.last_save = perf_counter()
+
+    def due(self):
+        return perf_counter() - self.last_save >= self.interval
+
+    def save(self, size, added_rules, buffer, valid_tactics, grounder, constrainer, tester):
+        state = {
+            'size': size,
+            'added_rules': added_rules,
+            'pending_rules': buffer.rule_sets,
+            'banished_rules': buffer.banished,
+            'valid_tactics': valid_tactics,
+            'bindings': grounder.seen_assignments,
+            'added_clauses': constrainer.added_clauses,
+            'tester': tester.cache_state(),
+        }
+        # written next to the checkpoint and renamed over it, so that a crash while saving keeps the previous one
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = perf_counter()
+
+    def restore(self, solver, buffer, grounder, constrainer, tester):
+        "Rebuilds the solver and the caches from the checkpoint, and returns the size, added rules and valid tactics to continue with"
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        for rules in state['added_rules']:
+            solver.add_ground_clauses(rules)
+        for rules in state['pending_rules']:
+            buffer.append(rules)
+        for rules in state['banished_rules']:
+            buffer.banish(rules)
+        grounder.seen_assignments.update(state['bindings'])
+        constrainer.added_clauses.update(state['added_clauses'])
+        tester.restore_cache(state['tester'])
+        return state['size'], state['added_rules'], state['valid_tactics']
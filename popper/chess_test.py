@@ -1,35 +1,145 @@
+import multiprocessing
 import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 
 import chess
+import pkg_resources
 from pyswip.prolog import PrologError
 
 from .core import Clause, Literal
-from tactics.util import assert_legal_moves, chess_examples, fen_to_contents, get_prolog
+from .util import format_program
+from tactics.util import PositionInterner, assert_legal_moves, bk_profile, chess_examples, fen_to_bitboards, fen_to_contents, get_prolog, legal_move_cache, legal_move_facts, merge_bk_profiles, start_bk_profile
 
+ChessExample = namedtuple('ChessExample', ['board', 'move', 'label', 'position', 'from_sq', 'to_sq', 'legal_moves', 'query'])
+
+def load_chess_examples(ex_file, eval_timeout, bitboards=False):
+    "Parse the examples once and pre-render everything needed to test a hypothesis against them"
+    render = fen_to_bitboards if bitboards else fen_to_contents
+    examples = []
+    for board, move, label in chess_examples(ex_file):
+        position = render(board.fen())
+        from_sq = chess.square_name(move.from_square)
+        to_sq = chess.square_name(move.to_square)
+        legal_moves = legal_move_facts(board, position)
+        query = f'call_with_time_limit({eval_timeout}, f({position}, {from_sq}, {to_sq}))'
+        examples.append(ChessExample(board, move, label, position, from_sq, to_sq, legal_moves, query))
+    return examples
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+def mask_indices(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+# how many tests to run between two reorderings of the examples
+REORDER_EVERY = 100
 
 class ChessTester():
-    def __init__(self, settings):
+    def __init__(self, settings, shard=(0, 1)):
         self.settings = settings
-        self.prolog = get_prolog(use_foreign_predicate=settings.fpred)
         self.eval_timeout = settings.eval_timeout
         self.already_checked_redundant_literals = set()
+        self.load_examples()
 
-        bk_pl_path = self.settings.bk_file
+        # the examples this tester runs through Prolog: every `num_shards`-th one, starting at `shard`
+        shard, num_shards = shard
+        self.shard = range(shard, len(self.examples), num_shards)
 
-        self.pos = []
-        self.neg = []
-        for ex in chess_examples(self.settings.ex_file):
-            if ex[2]:
-                self.pos.append(ex)
-            else:
-                self.neg.append(ex)
+        self.evaluator = None
+        if self.settings.test_backend == 'numpy':
+            from .numpy_eval import NumpyEvaluator
+            self.evaluator = NumpyEvaluator(self.examples, self.shard, foreign_legal_moves=self.settings.fpred)
+
+        # the NumPy backend only needs Prolog to be checked against
+        self.prolog = None
+        self.interner = None
+        if self.evaluator is None or self.settings.check_backend:
+            self.load_prolog()
 
-        for x in [bk_pl_path]:
+    def load_prolog(self):
+        self.prolog = get_prolog(use_foreign_predicate=self.settings.fpred)
+        bk_pl_path = self.settings.bk_file
+        pl_paths = [bk_pl_path]
+        if self.settings.batch_test:
+            pl_paths.append(pkg_resources.resource_filename(__name__, "lp/chess_test.pl"))
+        if self.settings.table_bk:
+            pl_paths.append(pkg_resources.resource_filename(__name__, "lp/chess_tabling.pl"))
+        for x in pl_paths:
             if os.name == 'nt': # if on Windows, SWI requires escaped directory separators
                 x = x.replace('\\', '\\\\')
             self.prolog.consult(x)
 
+        if self.settings.profile_bk:
+            start_bk_profile(self.prolog)
+
+        # materialised relations and successors are keyed by position ID, so they imply interning
+        if self.settings.intern_positions or self.settings.materialise or self.settings.successor_table:
+            self.intern_examples()
+
+        if self.settings.batch_test:
+            self.load_batch_examples()
+
+    def load_examples(self):
+        self.examples = load_chess_examples(self.settings.ex_file, self.eval_timeout, self.settings.bitboards)
+        self.pos = [ex for ex in self.examples if ex.label]
+        self.neg = [ex for ex in self.examples if not ex.label]
+
+        # example i is bit i of every coverage mask
+        self.pos_mask = sum(1 << i for i, ex in enumerate(self.examples) if ex.label)
+        self.neg_mask = sum(1 << i for i, ex in enumerate(self.examples) if not ex.label)
+        self.all_mask = (1 << len(self.examples)) - 1
+        self.seen_prog = {}
+
+        # examples covered by many programs are tried first, so that early testing finds a covered example sooner
+        self.cover_counts = [0] * len(self.examples)
+        self.order = list(range(len(self.examples)))
+        self.num_tests = 0
+
+    def intern_examples(self):
+        if self.settings.fpred:
+            raise ValueError('Interned positions need legal_move/3 to be asserted, not a foreign predicate')
+        if self.settings.bitboards:
+            raise ValueError('Interned positions are only supported with the contents/4 encoding, not bitboards')
+        self.interner = PositionInterner(self.prolog, materialise=self.settings.materialise, successors=self.settings.successor_table)
+        for i in self.shard:
+            example = self.examples[i]
+            pos_id = self.interner.intern(example.board)
+            query = f'call_with_time_limit({self.eval_timeout}, f({pos_id}, {example.from_sq}, {example.to_sq}))'
+            self.examples[i] = example._replace(position=str(pos_id), legal_moves=[], query=query)
+
+    def load_batch_examples(self):
+        self.prolog.assertz(f'chess_eval_timeout({self.eval_timeout})')
+        for i in self.shard:
+            example = self.examples[i]
+            self.prolog.assertz(f'chess_example({i}, {example.position}, {example.from_sq}, {example.to_sq}, {int(example.label)})')
+            if not self.settings.fpred and not self.interner:
+                moves = ', '.join(f'{chess.square_name(move.from_square)}-{chess.square_name(move.to_square)}' for move in example.board.legal_moves)
+                self.prolog.assertz(f'chess_example_legal_moves({i}, [{moves}])')
+
+    def counters(self):
+        counters = {}
+        if self.settings.fpred:
+            info = legal_move_cache.cache_info()
+            counters.update({'legal_move cache hits': info.hits, 'legal_move cache misses': info.misses})
+        if self.settings.table_bk and self.prolog:
+            for result in self.prolog.query('bk_table_counts(Name, Calls, Hits, Answers)'):
+                name = result['Name']
+                counters[f'{name} tabled calls'] = result['Calls']
+                counters[f'{name} table hits'] = result['Hits']
+                counters[f'{name} table answers'] = result['Answers']
+        return counters
+
+    def bk_profile(self):
+        return bk_profile(self.prolog) if self.prolog else {}
+
+    def close(self):
+        pass
+
     @contextmanager
     def using(self, rules):
         current_clauses = set()
@@ -69,50 +179,372 @@ class ChessTester():
         with self.using(program):
             return list(self.prolog.query(f'non_functional.'))
 
-    def test(self, rules):
-        tp, fn, tn, fp = 0, 0, 0, 0
+    @contextmanager
+    def example_context(self, example):
+        "Sets up the legal moves of an example for the queries run inside the block"
+        try:
+            if not self.settings.fpred and not self.interner:
+                with assert_legal_moves(self.prolog, example.board, example.legal_moves):
+                    yield
+            else:
+                # the legal moves are either foreign or were asserted once when the position was interned
+                yield
+        finally:
+            if self.settings.table_bk:
+                list(self.prolog.query('reset_bk_tables'))
+
+    def run_query(self, query):
+        "Returns whether the query succeeds, or None if it timed out"
+        try:
+            results = list(self.prolog.query(query))
+        except PrologError:
+            if not self.settings.fpred:
+                print(f'% timeout occurred on {query}')
+            return None
+        # call_with_time_limit/2 runs its goal as once/1, so a query has at most one answer, and the example is
+        # covered when the hypothesis has any solution on it; chess_test.pl counts answers of the same goal
+        return len(results) == 1
+
+    def test_example(self, example):
+        "Returns whether the asserted hypothesis covers the example, or None if the query timed out"
+        with self.example_context(example):
+            return self.run_query(example.query)
 
+    def batch_coverage(self, rules, ids, stop_on_cover):
+        # a single query tests all the given examples inside Prolog
+        query = 'chess_first_cover' if stop_on_cover else 'chess_coverage'
         with self.using(rules):
-            for board, move, label in chess_examples(self.settings.ex_file):
-                position = fen_to_contents(board.fen())
-                from_sq = chess.square_name(move.from_square)
-                to_sq = chess.square_name(move.to_square)
-
-                # query the relation with the current example
-                # TODO: eek, refactor this
-                query = f"f({position}, {from_sq}, {to_sq})"
-
-                if not self.settings.fpred:
-                    with assert_legal_moves(self.prolog, board):
-                        try:
-                            results = list(self.prolog.query(f'call_with_time_limit({self.eval_timeout}, {query})'))
-                            if len(results) == 1:
-                                prediction = True
-                            else:
-                                prediction = False
-                        except PrologError:
-                            print(f'% timeout occurred on {query}')
-                            # don't use this example if timeout occurred
-                            continue
-                else:
-                    try:
-                        results = list(self.prolog.query(f'call_with_time_limit({self.eval_timeout}, {query})'))
-                        if len(results) == 1:
-                            prediction = True
-                        else:
-                            prediction = False
-                    except PrologError:
-                        prediction = False
-                        # don't use this example if timeout occurred
-                        continue
-                
-                if prediction and label:
-                    tp += 1
-                elif prediction and not label:
-                    fp += 1
-                elif not prediction and label:
-                    fn += 1
-                elif not prediction and not label:
-                    tn += 1
+            result = next(self.prolog.query(f'{query}({list(ids)}, Covered, Skipped)'))
+        covered = sum(1 << i for i in result['Covered'])
+        skipped = 0
+        for i in result['Skipped']:
+            if not self.settings.fpred:
+                print(f'% timeout occurred on {self.examples[i].query}')
+            skipped |= 1 << i
+        evaluated = 0
+        for i in ids:
+            evaluated |= 1 << i
+            if covered >> i & 1 and stop_on_cover:
+                break
+        return covered, skipped, evaluated
+
+    def coverage(self, rules, ids, stop_on_cover=False):
+        "Tests the examples in `ids` in order, and returns masks of the covered, timed out and evaluated examples"
+        if self.evaluator:
+            return self.evaluator_coverage(rules, ids)
+        return self.prolog_coverage(rules, ids, stop_on_cover)
+
+    def evaluator_coverage(self, rules, ids):
+        # every example is tested at once, so there is nothing to gain from stopping at the first covered one
+        covered = self.evaluator.coverage(rules, ids)
+        evaluated = 0
+        for i in ids:
+            evaluated |= 1 << i
+        # the evaluator has no time limit, so only Prolog can time out
+        skipped = 0
+        if self.settings.check_backend:
+            from .numpy_eval import BackendMismatchError
+            prolog_covered, skipped, _ = self.prolog_coverage(rules, ids)
+            mismatch = (covered ^ prolog_covered) & ~skipped
+            if mismatch:
+                raise BackendMismatchError(f'NumPy and Prolog coverage differ on examples {list(mask_indices(mismatch))} for {format_program(rules)}')
+        return covered & ~skipped, skipped, evaluated
 
+    def prolog_coverage(self, rules, ids, stop_on_cover=False):
+        if self.settings.batch_test:
+            return self.batch_coverage(rules, ids, stop_on_cover)
+        covered, skipped, evaluated = 0, 0, 0
+        with self.using(rules):
+            for i in ids:
+                prediction = self.test_example(self.examples[i])
+                evaluated |= 1 << i
+                if prediction is None:
+                    skipped |= 1 << i
+                elif prediction:
+                    covered |= 1 << i
+                    if stop_on_cover:
+                        break
+        return covered, skipped, evaluated
+
+    def coverage_many(self, programs, order, pending, stop_on_cover=False):
+        "Like `coverage` for several programs, each tested on the examples of `order` that are set in its `pending` mask"
+        if self.evaluator or self.settings.batch_test or len(programs) == 1:
+            return [self.coverage(rules, [i for i in order if mask >> i & 1], stop_on_cover) for rules, mask in zip(programs, pending)]
+
+        # every program gets its own head predicate, so that all of them can be asserted at once
+        numbered = []
+        for k, rules in enumerate(programs):
+            for head, body in rules:
+                numbered.append((Literal(f'{head.predicate}_{k}', head.arguments, head.directions), body))
+        results = [[0, 0, 0] for _ in programs]
+        pending = list(pending)
+        with self.using(numbered):
+            for i in order:
+                todo = [k for k, mask in enumerate(pending) if mask >> i & 1]
+                if not todo:
+                    continue
+                # the position is set up once and shared by every program that still needs this example
+                example = self.examples[i]
+                with self.example_context(example):
+                    for k in todo:
+                        prediction = self.run_query(f'call_with_time_limit({self.eval_timeout}, f_{k}({example.position}, {example.from_sq}, {example.to_sq}))')
+                        results[k][2] |= 1 << i
+                        if prediction is None:
+                            results[k][1] |= 1 << i
+                        elif prediction:
+                            results[k][0] |= 1 << i
+                            if stop_on_cover:
+                                pending[k] = 0
+        return [tuple(result) for result in results]
+
+    def conf_matrix(self, covered, skipped, evaluated):
+        # don't use examples for which a timeout occurred
+        uncovered = evaluated & ~(covered | skipped)
+        tp = popcount(covered & self.pos_mask)
+        fn = popcount(uncovered & self.pos_mask)
+        tn = popcount(uncovered & self.neg_mask)
+        fp = popcount(covered & self.neg_mask)
         return tp, fn, tn, fp
+
+    def cache_state(self):
+        return {'num_examples': len(self.examples), 'seen_prog': self.seen_prog, 'cover_counts': self.cover_counts, 'order': self.order, 'num_tests': self.num_tests}
+
+    def restore_cache(self, state):
+        if state['num_examples'] != len(self.examples):
+            raise ValueError(f'The checkpoint was taken with {state["num_examples"]} examples, not {len(self.examples)}')
+        self.seen_prog = state['seen_prog']
+        self.cover_counts = state['cover_counts']
+        self.order = state['order']
+        self.num_tests = state['num_tests']
+
+    def update_order(self, covered):
+        for i in mask_indices(covered):
+            self.cover_counts[i] += 1
+        self.num_tests += 1
+        if self.num_tests % REORDER_EVERY == 0:
+            self.order.sort(key=lambda i: -self.cover_counts[i])
+
+    def uncovered_by_generalisations(self, rules):
+        "The examples that a tested generalisation of a single-clause program, its clause without one body literal, does not cover"
+        # every relation of the background knowledge is monotone, so a clause fails wherever a clause with fewer body
+        # literals fails; timed out and untested examples of the generalisation say nothing
+        if len(rules) != 1:
+            return 0
+        (head, body), = rules
+        uncovered = 0
+        for literal in body:
+            covered, skipped, evaluated = self.seen_prog.get(frozenset([Clause.canonical_form((head, body - {literal}))]), (0, 0, 0))
+            uncovered |= evaluated & ~(covered | skipped)
+        return uncovered
+
+    def known(self, prog_hash, rules):
+        "The covered, timed out and evaluated masks of a program, from its own tests and, with --early-test, from those of its generalisations"
+        covered, skipped, evaluated = self.seen_prog.get(prog_hash, (0, 0, 0))
+        if self.settings.early_test and evaluated != self.all_mask:
+            evaluated |= self.uncovered_by_generalisations(rules) & ~covered
+        return covered, skipped, evaluated
+
+    def is_exact(self, rules):
+        "Whether every example of a program has been evaluated, so that its confusion matrix is complete"
+        prog_hash = frozenset(Clause.canonical_form(rule) for rule in rules)
+        return self.known(prog_hash, rules)[2] == self.all_mask
+
+    def test(self, rules, stop_on_cover=False):
+        # with `stop_on_cover` testing stops at the first covered example, so the counts are only exact for programs
+        # that cover nothing; a later call without it resumes from the examples that were not evaluated yet
+        prog_hash = frozenset(Clause.canonical_form(rule) for rule in rules)
+        covered, skipped, evaluated = self.known(prog_hash, rules)
+        if evaluated != self.all_mask and not (stop_on_cover and covered):
+            ids = [i for i in self.order if not evaluated >> i & 1]
+            new_covered, new_skipped, new_evaluated = self.coverage(rules, ids, stop_on_cover)
+            covered |= new_covered
+            skipped |= new_skipped
+            evaluated |= new_evaluated
+            self.update_order(new_covered)
+        self.seen_prog[prog_hash] = (covered, skipped, evaluated)
+        return self.conf_matrix(covered, skipped, evaluated)
+
+    def test_many(self, programs, stop_on_cover=False):
+        "Like `test` for a chunk of programs, but every example is set up once for all of them"
+        keys = [frozenset(Clause.canonical_form(rule) for rule in rules) for rules in programs]
+        todo = {}
+        for key, rules in zip(keys, programs):
+            if key in todo:
+                continue
+            self.seen_prog[key] = self.known(key, rules)
+            covered, _, evaluated = self.seen_prog[key]
+            if evaluated != self.all_mask and not (stop_on_cover and covered):
+                todo[key] = rules
+        if todo:
+            pending = [self.all_mask & ~self.seen_prog[key][2] for key in todo]
+            results = self.coverage_many(list(todo.values()), self.order, pending, stop_on_cover)
+            for key, (new_covered, new_skipped, new_evaluated) in zip(todo, results):
+                covered, skipped, evaluated = self.seen_prog[key]
+                self.seen_prog[key] = (covered | new_covered, skipped | new_skipped, evaluated | new_evaluated)
+                self.update_order(new_covered)
+        return [self.conf_matrix(*self.seen_prog[key]) for key in keys]
+
+def test_worker(settings, shard, num_shards, conn):
+    tester = ChessTester(settings, shard=(shard, num_shards))
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        method, args = job
+        conn.send(getattr(tester, method)(*args))
+    tester.close()
+
+class ParallelChessTester(ChessTester):
+    def __init__(self, settings):
+        self.settings = settings
+        self.eval_timeout = settings.eval_timeout
+        self.already_checked_redundant_literals = set()
+        self.load_examples()
+
+        # spawn rather than fork, so that no worker inherits an initialised Prolog engine
+        ctx = multiprocessing.get_context('spawn')
+        num_shards = settings.test_workers
+        self.workers = []
+        for shard in range(num_shards):
+            conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(target=test_worker, args=(settings, shard, num_shards, worker_conn), daemon=True)
+            process.start()
+            self.workers.append((process, conn))
+
+    def coverage(self, rules, ids, stop_on_cover=False):
+        # example i belongs to worker i % num_shards
+        num_shards = len(self.workers)
+        for shard, (_, conn) in enumerate(self.workers):
+            conn.send(('coverage', (rules, [i for i in ids if i % num_shards == shard], stop_on_cover)))
+        covered, skipped, evaluated = 0, 0, 0
+        for _, conn in self.workers:
+            shard_covered, shard_skipped, shard_evaluated = conn.recv()
+            covered |= shard_covered
+            skipped |= shard_skipped
+            evaluated |= shard_evaluated
+        return covered, skipped, evaluated
+
+    def coverage_many(self, programs, order, pending, stop_on_cover=False):
+        num_shards = len(self.workers)
+        for shard, (_, conn) in enumerate(self.workers):
+            shard_mask = sum(1 << i for i in range(shard, len(self.examples), num_shards))
+            conn.send(('coverage_many', (programs, [i for i in order if i % num_shards == shard], [mask & shard_mask for mask in pending], stop_on_cover)))
+        results = [[0, 0, 0] for _ in programs]
+        for _, conn in self.workers:
+            for result, shard_result in zip(results, conn.recv()):
+                for j in range(3):
+                    result[j] |= shard_result[j]
+        return [tuple(result) for result in results]
+
+    def counters(self):
+        for _, conn in self.workers:
+            conn.send(('counters', ()))
+        counters = {}
+        for _, conn in self.workers:
+            for name, value in conn.recv().items():
+                counters[name] = counters.get(name, 0) + value
+        return counters
+
+    def bk_profile(self):
+        for _, conn in self.workers:
+            conn.send(('bk_profile', ()))
+        profile = {}
+        for _, conn in self.workers:
+            merge_bk_profiles(profile, conn.recv())
+        return profile
+
+    def close(self):
+        for _, conn in self.workers:
+            conn.send(None)
+        for process, _ in self.workers:
+            process.join()
+        self.workers = []
+
+# the tester of a pipeline worker process, which tests whole programs on every example
+pool_tester = None
+
+def init_pool_tester(settings):
+    global pool_tester
+    pool_tester = ChessTester(settings)
+
+def pool_coverage(rules, ids, stop_on_cover):
+    coverage = pool_tester.coverage(rules, ids, stop_on_cover)
+    # the pool gives no way to reach every worker, so each result carries its worker's running totals
+    profile = pool_tester.bk_profile() if pool_tester.settings.profile_bk else {}
+    return coverage, (os.getpid(), pool_tester.counters(), profile)
+
+class PipelinedChessTester(ChessTester):
+    def __init__(self, settings):
+        self.settings = settings
+        self.eval_timeout = settings.eval_timeout
+        self.already_checked_redundant_literals = set()
+        self.load_examples()
+
+        # spawn rather than fork, so that no worker inherits an initialised Prolog engine
+        self.pool = ProcessPoolExecutor(max_workers=settings.test_workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=init_pool_tester, initargs=(settings,))
+        # programs being tested in the background, by their canonical form
+        self.pending = {}
+        # the latest counters and bk profile of each worker process, by its pid
+        self.reports = {}
+
+    def collect(self, future):
+        coverage, (pid, counters, profile) = future.result()
+        self.reports[pid] = (counters, profile)
+        return coverage
+
+    def coverage(self, rules, ids, stop_on_cover=False):
+        return self.collect(self.pool.submit(pool_coverage, rules, ids, stop_on_cover))
+
+    def coverage_many(self, programs, order, pending, stop_on_cover=False):
+        futures = [self.pool.submit(pool_coverage, rules, [i for i in order if mask >> i & 1], stop_on_cover) for rules, mask in zip(programs, pending)]
+        return [self.collect(future) for future in futures]
+
+    def submit(self, rules, stop_on_cover=False):
+        "Starts testing a program in the background, and returns the key that `result` collects it with"
+        prog_hash = frozenset(Clause.canonical_form(rule) for rule in rules)
+        self.seen_prog[prog_hash] = self.known(prog_hash, rules)
+        covered, _, evaluated = self.seen_prog[prog_hash]
+        if evaluated != self.all_mask and not (stop_on_cover and covered):
+            ids = [i for i in self.order if not evaluated >> i & 1]
+            self.pending[prog_hash] = self.pool.submit(pool_coverage, rules, ids, stop_on_cover)
+        return prog_hash
+
+    def merge(self, prog_hash, future):
+        new_covered, new_skipped, new_evaluated = self.collect(future)
+        covered, skipped, evaluated = self.seen_prog[prog_hash]
+        self.seen_prog[prog_hash] = (covered | new_covered, skipped | new_skipped, evaluated | new_evaluated)
+        self.update_order(new_covered)
+
+    def result(self, prog_hash):
+        if prog_hash in self.pending:
+            self.merge(prog_hash, self.pending.pop(prog_hash))
+        return self.conf_matrix(*self.seen_prog[prog_hash])
+
+    def discard(self, keys):
+        "Drops programs whose results will not be collected, keeping the results that are already in"
+        for prog_hash in keys:
+            future = self.pending.pop(prog_hash, None)
+            if future is None:
+                continue
+            if future.done() and not future.cancelled():
+                self.merge(prog_hash, future)
+            else:
+                # a test that has already started runs to the end, and its result is lost
+                future.cancel()
+
+    def counters(self):
+        counters = {}
+        for worker_counters, _ in self.reports.values():
+            for name, value in worker_counters.items():
+                counters[name] = counters.get(name, 0) + value
+        return counters
+
+    def bk_profile(self):
+        profile = {}
+        for _, worker_profile in self.reports.values():
+            merge_bk_profiles(profile, worker_profile)
+        return profile
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
@@ -1,4 +1,5 @@
 from collections import namedtuple, defaultdict
+from itertools import permutations
 
 ConstVar = namedtuple('ConstVar', ['name', 'type'])
 
@@ -35,13 +36,11 @@ class Grounding:
         return (ground_head, ground_body)
 
     # AC: When grounding constraint rules, we only care about the vars and the constraints, not the actual literals
+    # the key is built from reprs of the sorted vars and constraints rather than from hash(), which python salts per process, so it is the same in every run and can key a cache on disk
     @staticmethod
-    def grounding_hash(body, all_vars):
-        cons = set()
-        for lit in body:
-            if lit.meta:
-                cons.add((lit.predicate, lit.arguments))
-        return hash((frozenset(all_vars), frozenset(cons)))
+    def grounding_key(body, all_vars, max_clauses, max_vars):
+        cons = sorted(repr((lit.predicate, lit.arguments)) for lit in body if lit.meta)
+        return repr((sorted(all_vars), cons, max_clauses, max_vars))
 
     @staticmethod
     def find_all_vars(body):
@@ -143,6 +142,27 @@ class Clause:
         b = frozenset(literal.my_hash() for literal in body)
         return hash((h,b))
 
+    # body-only variables are interchangeable, so we rename them every possible way and keep the smallest body
+    @staticmethod
+    def canonical_form(clause):
+        (head, body) = clause
+        argmap = {}
+        if head:
+            for arg in head.arguments:
+                argmap.setdefault(arg, f'H{len(argmap)}')
+        body_vars = sorted({arg for literal in body for arg in literal.arguments if arg not in argmap})
+        best = None
+        for names in permutations(range(len(body_vars))):
+            renamed = dict(argmap)
+            renamed.update((var, f'V{i}') for var, i in zip(body_vars, names))
+            key = tuple(sorted((literal.predicate, tuple(renamed[arg] for arg in literal.arguments)) for literal in body))
+            if best is None or key < best:
+                best = key
+        h = None
+        if head:
+            h = (head.predicate, tuple(argmap[arg] for arg in head.arguments))
+        return (h, best)
+
     @staticmethod
     def is_recursive(clause):
         (head, body) = clause
@@ -0,0 +1,33 @@
+from time import time
+
+class Deadline:
+    "The time by which an anytime search must stop, and the share of it that the current program size may use"
+    def __init__(self, settings, max_size):
+        # wall-clock time rather than perf_counter, so that the processes of a partitioned search agree on it
+        self.end = settings.deadline
+        self.split = settings.split_budget
+        # the sizes above the largest program the bias allows have no models, so they get no share of the time
+        self.max_size = min(settings.max_literals, max_size)
+        self.size_end = self.end
+        self.sizes_cut = 0
+
+    def start_size(self, size):
+        if self.end is None or not self.split:
+            return
+        # the time left is shared evenly between the sizes left, so what a size does not use goes to the next ones
+        now = time()
+        self.size_end = now + (self.end - now) / max(1, self.max_size - size + 1)
+
+    def expired(self):
+        return self.end is not None and time() >= self.size_end
+
+    def passed(self):
+        return self.end is not None and time() >= self.end
+
+    def cut(self):
+        self.sizes_cut += 1
+
+    def counters(self):
+        if self.end is None:
+            return {}
+        return {'sizes cut short': self.sizes_cut}
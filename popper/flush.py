@@ -0,0 +1,117 @@
+from .asp import atom_to_symbol
+from .core import Clause
+
+class ConstraintBuffer:
+    "The ground rules waiting to be added to the solver, indexed so that a model can be checked against them"
+    def __init__(self):
+        self.rule_sets = []
+        self.banished = []
+        # included_clause atom -> the bodies of the buffered rules that derive it
+        self.inclusions = {}
+        self.constraints = []
+
+    def __len__(self):
+        return len(self.rule_sets)
+
+    def __iter__(self):
+        yield from self.rule_sets
+        yield from self.banished
+
+    def index(self, rules):
+        for head, body in rules:
+            body = [(sign, atom_to_symbol(pred, args)) for sign, pred, args in body]
+            if head:
+                _, pred, args = head
+                self.inclusions.setdefault(atom_to_symbol(pred, args), []).append(body)
+            else:
+                self.constraints.append(body)
+
+    def append(self, rules):
+        self.rule_sets.append(rules)
+        self.index(rules)
+
+    def banish(self, rules):
+        # banished programs do not count towards the flush limit
+        self.banished.append(rules)
+        self.index(rules)
+
+    def clear(self):
+        self.rule_sets = []
+        self.banished = []
+        self.inclusions = {}
+        self.constraints = []
+
+    def prunes(self, model):
+        "Whether the solver would not have returned the model if the buffered rules had already been added"
+        derived = {}
+        def holds(sign, symbol):
+            if symbol in self.inclusions:
+                if symbol not in derived:
+                    derived[symbol] = any(all(holds(*literal) for literal in body) for body in self.inclusions[symbol])
+                value = derived[symbol]
+            else:
+                # an atom of the solver's own program, or an included_clause that an earlier flush added
+                value = model.contains(symbol)
+            return value == sign
+        return any(all(holds(sign, symbol) for sign, symbol in body) for body in self.constraints)
+
+class FlushPolicy:
+    "Decides when the buffered constraints are added to the solver, and counts the programs tested needlessly"
+    def __init__(self, settings, stats):
+        self.stats = stats
+        self.adaptive = settings.flush_policy == 'adaptive'
+        self.limit = settings.flush_limit
+        # checking every model against the buffer has a cost, so it is only done when it is needed or reported
+        self.check = self.adaptive or settings.stats
+        # the programs generated since the last flush, and in the window before it
+        self.seen = set()
+        self.previous = set()
+        self.redundant = 0
+        self.total_redundant = 0
+        self.regenerated = 0
+        self.flushes = 0
+
+    def record(self, program, model, buffer):
+        if not self.check:
+            return
+        key = frozenset(Clause.canonical_form(rule) for rule in program)
+        if key in self.previous:
+            self.regenerated += 1
+        self.seen.add(key)
+        if buffer.constraints and buffer.prunes(model):
+            self.redundant += 1
+            self.total_redundant += 1
+
+    def total(self, *operations):
+        return sum(self.stats.durations[operation].total for operation in operations if operation in self.stats.durations)
+
+    def should_flush(self, buffer):
+        if len(buffer) >= self.limit:
+            return True
+        if not self.adaptive or not self.redundant or not len(buffer):
+            return False
+        # flush once the programs that the buffer would have pruned cost more to test than a flush costs
+        program_cost = self.total('test', 'test_chunk', 'complete', 'build', 'ground') / max(1, self.stats.total_programs)
+        if self.flushes:
+            flush_cost = self.total('add', 'restart') / self.flushes
+        elif 'start' in self.stats.durations:
+            # no flush has been timed yet, so a restart is taken to cost what starting the search of a size did
+            flush_cost = self.stats.durations['start'].mean()
+        else:
+            return False
+        return self.redundant * program_cost >= flush_cost
+
+    def flushed(self):
+        self.redundant = 0
+        self.flushes += 1
+        # the solver only generates a model once between flushes, so a restarted solver regenerates programs from the
+        # windows before it, and only the last one is kept to bound the memory this takes
+        self.previous = self.seen
+        self.seen = set()
+
+    def counters(self):
+        counters = {'flushes': self.flushes}
+        if self.check:
+            counters['regenerated programs'] = self.regenerated
+            counters['redundant programs'] = self.total_redundant
+        return counters
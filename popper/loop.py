@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
 import logging
+import multiprocessing
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, time
 from . util import Settings, Stats, timeout, parse_settings, format_program
 from . asp import ClingoGrounder, ClingoSolver
 from . tester import Tester
 from . constrain import Constrain
 from . generate import generate_program
 from . core import Grounding, Clause
-from . chess_test import ChessTester
+from . chess_test import ChessTester, ParallelChessTester, PipelinedChessTester
+from . flush import ConstraintBuffer, FlushPolicy
+from . checkpoint import Checkpoint
+from . deadline import Deadline
 
 class Outcome:
     ALL = 'all'
@@ -128,81 +135,251 @@ def calc_score(conf_matrix):
     tp, fn, tn, fp = conf_matrix
     return tp + tn
 
-def popper(settings, stats):
+def handle_program(settings, stats, tester, constrainer, grounder, solver, program, before, min_clause, conf_matrix, constraint_rule_buffer, flush_policy, valid_tactics):
+    "Builds and buffers the constraints of a tested program, returns whether to flush the constraint buffer"
+    # the search only needs to know whether a program covers any example, so the counts of a program whose testing
+    # stopped at its first covered example are only completed when they are logged
+    if settings.early_test and settings.debug and not tester.is_exact(program):
+        with stats.duration('complete'):
+            conf_matrix = tester.test(program)
+
+    outcome = decide_outcome(conf_matrix)
+    score = calc_score(conf_matrix)
+
+    stats.register_program(program, conf_matrix)
+
+    # # UPDATE BEST PROGRAM
+    # if best_score == None or score > best_score:
+    #     best_score = score
+
+    #     if outcome == (Outcome.ALL, Outcome.NONE):
+    #         stats.register_solution(program, conf_matrix)
+    #         return stats.solution.code
+
+    #     stats.register_best_program(program, conf_matrix)
+
+    # BUILD RULES
+    with stats.duration('build'):
+        rules = build_rules(settings, stats, constrainer, tester, program, before, min_clause, outcome, conf_matrix)
+
+    # GROUND RULES
+    with stats.duration('ground'):
+        rules = ground_rules(stats, grounder, solver.max_clauses, solver.max_vars, rules)
+
+    # if we generate constraints, add them to the buffer
+    if rules:
+        constraint_rule_buffer.append(rules)
+    else:
+        print(f'% {format_program(program)}')
+        valid_tactics.add(format_program(program))
+        if settings.flush_continue:
+            with stats.duration('ground'):
+                banish_rules = ground_rules(stats, grounder, solver.max_clauses, solver.max_vars, set(constrainer.banish_constraint(program, before, min_clause)))
+            constraint_rule_buffer.banish(banish_rules)
+
+    return flush_policy.should_flush(constraint_rule_buffer)
+
+def test_chunk(settings, stats, tester, constrainer, grounder, solver, chunk, constraint_rule_buffer, flush_policy, valid_tactics):
+    "Tests a chunk of generated programs and handles them in the order they were generated, returns whether to flush the constraint buffer"
+    programs = [program for program, _, _ in chunk]
+
+    # TEST HYPOTHESES
+    # a chunk is tested at once, so its time is kept apart from the time to test a single program
+    with stats.duration('test_chunk' if settings.test_chunk > 1 else 'test'):
+        conf_matrices = tester.test_many(programs, stop_on_cover=settings.early_test)
+
+    for (program, before, min_clause), conf_matrix in zip(chunk, conf_matrices):
+        # when the buffer is flushed, the solver is restarted and the rest of the chunk is generated again, so it is
+        # dropped here; the solver has still searched past the flush point, which changes the order of the models after
+        # the restart, so the valid tactics are the same as testing one program at a time but the programs tested are not
+        if handle_program(settings, stats, tester, constrainer, grounder, solver, program, before, min_clause, conf_matrix, constraint_rule_buffer, flush_policy, valid_tactics):
+            return True
+    return False
+
+def test_submitted(settings, stats, tester, constrainer, grounder, solver, submitted, constraint_rule_buffer, flush_policy, valid_tactics):
+    "Waits for the result of a program submitted to a pipelined tester and handles it, returns whether to flush the constraint buffer"
+    program, before, min_clause, key = submitted
+    with stats.duration('test'):
+        conf_matrix = tester.result(key)
+    return handle_program(settings, stats, tester, constrainer, grounder, solver, program, before, min_clause, conf_matrix, constraint_rule_buffer, flush_policy, valid_tactics)
+
+def search(settings, stats, partition=None):
+    "Searches the hypothesis space, or the part of it given by `partition`, and returns the valid tactics and the grounder"
     solver = ClingoSolver(settings)
-    tester = ChessTester(settings)
+    if partition:
+        solver.restrict_to_partition(*partition)
+    if settings.pipeline:
+        tester = PipelinedChessTester(settings)
+    elif settings.test_workers > 1:
+        tester = ParallelChessTester(settings)
+    else:
+        tester = ChessTester(settings)
     settings.num_pos, settings.num_neg = len(tester.pos), len(tester.neg)
-    grounder = ClingoGrounder()
+    grounder = ClingoGrounder(cache_file=settings.grounding_cache)
     constrainer = Constrain()
-    constraint_rule_buffer = []
+    constraint_rule_buffer = ConstraintBuffer()
+    flush_policy = FlushPolicy(settings, stats)
+    deadline = Deadline(settings, solver.max_size)
     valid_tactics = set()
-    BUFFER_LIMIT = 1000 # update after every `BUFFER_LIMIT` constraints added
-
-    for size in range(1, settings.max_literals + 1):
+    added_rules = []
+    start_size = 1
+
+    checkpoint = None
+    if settings.checkpoint_file:
+        checkpoint = Checkpoint(settings.checkpoint_file, settings.checkpoint_interval)
+    if settings.resume:
+        if not checkpoint:
+            raise ValueError('--resume needs a --checkpoint file to resume from')
+        # replaying the added constraints prunes every program that was pruned before the checkpoint
+        with stats.duration('resume'):
+            start_size, added_rules, valid_tactics = checkpoint.restore(solver, constraint_rule_buffer, grounder, constrainer, tester)
+        print(f'% resuming at size:{start_size}')
+
+    for size in range(start_size, settings.max_literals + 1):
         stats.update_num_literals(size)
         solver.update_number_of_literals(size)
         solver.solver.configuration.solve.models = 0
         all_rules = []
 
         print(f'% searching programs of size:{size}')
+        deadline.start_size(size)
 
+        started = False
+        restarted = False
+        timed_out = False
         while True:
+            flush = False
+            restart_start = perf_counter()
+            # the solver only searches for the next model when the loop asks for it, so in pipelined mode it is
+            # the testing, in the background workers, that overlaps generating, building and grounding
             with solver.solver.solve(yield_ = True) as handle:
+                chunk = []
+                submitted = deque()
                 for m in handle:
+                    # the deadline is only checked between models, so a long wait for the next one can overrun it
+                    if deadline.expired():
+                        timed_out = True
+                        break
+                    if restarted:
+                        # the time to the first model after a flush is part of its cost
+                        stats.register_duration('restart', perf_counter() - restart_start)
+                        restarted = False
+                    elif not started:
+                        # and the time to the first model of a size is what a restart is expected to cost before one
+                        stats.register_duration('start', perf_counter() - restart_start)
+                    started = True
                     model = m.symbols(shown = True)
                     # GENERATE HYPOTHESIS
                     with stats.duration('generate'):
                         program, before, min_clause = generate_program(model)
-
-                    # TEST HYPOTHESIS
-                    with stats.duration('test'):
-                        conf_matrix = tester.test(program)
-                        outcome = decide_outcome(conf_matrix)
-                        score = calc_score(conf_matrix)
-
-                    stats.register_program(program, conf_matrix)
-
-                    # # UPDATE BEST PROGRAM
-                    # if best_score == None or score > best_score:
-                    #     best_score = score
-
-                    #     if outcome == (Outcome.ALL, Outcome.NONE):
-                    #         stats.register_solution(program, conf_matrix)
-                    #         return stats.solution.code
-
-                    #     stats.register_best_program(program, conf_matrix)
-
-                    # BUILD RULES
-                    with stats.duration('build'):
-                        rules = build_rules(settings, stats, constrainer, tester, program, before, min_clause, outcome, conf_matrix)
-
-                    # GROUND RULES
-                    with stats.duration('ground'):
-                        rules = ground_rules(stats, grounder, solver.max_clauses, solver.max_vars, rules)
-
-                    # if we generate constraints, add them to the buffer
-                    if rules:
-                        constraint_rule_buffer.append(rules)
-                    else:
-                        print(f'% {format_program(program)}')
-                        valid_tactics.add(format_program(program))
-                    
-                    # if the buffer exceeds the limit, apply the constraints and restart the solver
-                    if len(constraint_rule_buffer) >= BUFFER_LIMIT:
+                    flush_policy.record(program, m, constraint_rule_buffer)
+
+                    if settings.pipeline:
+                        # results are handled in the order the programs were generated, at most `pipeline` programs behind
+                        submitted.append((program, before, min_clause, tester.submit(program, stop_on_cover=settings.early_test)))
+                        if len(submitted) <= settings.pipeline:
+                            continue
+                        flush = test_submitted(settings, stats, tester, constrainer, grounder, solver, submitted.popleft(), constraint_rule_buffer, flush_policy, valid_tactics)
+                        if flush:
+                            break
+                        continue
+
+                    chunk.append((program, before, min_clause))
+                    if len(chunk) < settings.test_chunk:
+                        continue
+                    flush = test_chunk(settings, stats, tester, constrainer, grounder, solver, chunk, constraint_rule_buffer, flush_policy, valid_tactics)
+                    if flush:
                         break
+                    chunk = []
+                else:
+                    # the last models of this size
+                    if chunk:
+                        flush = test_chunk(settings, stats, tester, constrainer, grounder, solver, chunk, constraint_rule_buffer, flush_policy, valid_tactics)
+                    while submitted and not flush:
+                        flush = test_submitted(settings, stats, tester, constrainer, grounder, solver, submitted.popleft(), constraint_rule_buffer, flush_policy, valid_tactics)
+            if submitted:
+                # as with a chunk, the programs submitted after a flush are generated again, so their tests are dropped
+                tester.discard([key for _, _, _, key in submitted])
+
+            if timed_out:
+                break
 
             # UPDATE SOLVER
-            if len(constraint_rule_buffer) >= BUFFER_LIMIT:
+            if flush:
                 with stats.duration('add'):
                     for rules in constraint_rule_buffer:
                         solver.add_ground_clauses(rules)
-                    constraint_rule_buffer = []
+                        added_rules.append(rules)
+                    constraint_rule_buffer.clear()
+                flush_policy.flushed()
+                restarted = True
+                if checkpoint and checkpoint.due():
+                    with stats.duration('checkpoint'):
+                        checkpoint.save(size, added_rules, constraint_rule_buffer, valid_tactics, grounder, constrainer, tester)
                 continue
 
             # all models of this size exhausted, restart with new size
             break
 
+        if timed_out and deadline.passed():
+            print(f'% time limit reached at size:{size}')
+            # resuming from the checkpoint searches this size again, skipping the programs already pruned
+            if checkpoint:
+                with stats.duration('checkpoint'):
+                    checkpoint.save(size, added_rules, constraint_rule_buffer, valid_tactics, grounder, constrainer, tester)
+            break
+        if timed_out:
+            print(f'% time budget of size:{size} spent')
+            deadline.cut()
+
+        if checkpoint:
+            with stats.duration('checkpoint'):
+                checkpoint.save(size + 1, added_rules, constraint_rule_buffer, valid_tactics, grounder, constrainer, tester)
+
+    stats.register_counters(tester.counters())
+    stats.register_counters(grounder.counters())
+    stats.register_counters(flush_policy.counters())
+    stats.register_counters(deadline.counters())
+    if settings.profile_bk:
+        stats.register_bk_profile(tester.bk_profile())
+    tester.close()
+    return valid_tactics, grounder
+
+def search_partition(settings, k, num_partitions):
+    stats = Stats()
+    valid_tactics, grounder = search(settings, stats, (k, num_partitions))
+    return valid_tactics, stats, grounder.seen_assignments
+
+def partitioned_search(settings, stats):
+    "Searches every partition of the hypothesis space in a process of its own, and merges what they find"
+    if settings.checkpoint_file:
+        raise ValueError('--checkpoint cannot be used with --search-workers')
+    # constraints only prune programs that cover no example, so the partitions find the same
+    # valid tactics as a single search, although each one prunes only its own programs
+    num_partitions = settings.search_workers
+    grounder = ClingoGrounder(cache_file=settings.grounding_cache)
+    valid_tactics = set()
+    with ProcessPoolExecutor(max_workers=num_partitions, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(search_partition, settings, k, num_partitions) for k in range(num_partitions)]
+        for k, future in enumerate(futures):
+            part_tactics, part_stats, bindings = future.result()
+            valid_tactics |= part_tactics
+            stats.merge(part_stats)
+            # the slowest partition decides when the search ends, so how evenly they are split is reported
+            stats.register_counters({f'partition {k} programs': part_stats.total_programs})
+            grounder.seen_assignments.update(bindings)
+    return valid_tactics, grounder
+
+def popper(settings, stats):
+    if settings.anytime:
+        settings.deadline = time() + settings.timeout
+    if settings.search_workers > 1:
+        valid_tactics, grounder = partitioned_search(settings, stats)
+    else:
+        valid_tactics, grounder = search(settings, stats)
+    grounder.save()
     write_valid_programs(valid_tactics)
+    sys.stdout.flush()
     stats.register_completion()
     return stats.best_program.code if stats.best_program else None
 
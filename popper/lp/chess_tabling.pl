@@ -0,0 +1,49 @@
+%%%%%%%%%% PER-EXAMPLE TABLING OF THE BACKGROUND KNOWLEDGE %%%%%%%%%%
+
+% A table keeps each distinct answer once, so a tabled predicate can have fewer answers than its rules, e.g. one
+% attacks/3 answer where the four legal_move/3 facts of a promotion give four. An example is covered when f/3 has any
+% solution (see test_chess_ex/2 in chess_test.pl), which a table does not change, so only timeouts can differ: a
+% tabled call finds all its answers before it returns the first one.
+% legal_move/3 is left out: it is a fact lookup or a foreign predicate, so a table would only copy it
+tabled_bk(attacks/3).
+tabled_bk(piece_at/4).
+tabled_bk(behind/4).
+
+% flag/3 only uses the name of a compound key, so every counter gets an atom of its own
+bk_counter(Kind, Name, Key):-
+    atomic_list_concat([tabled, Kind, Name], '_', Key).
+
+% counts every call, including the ones answered from a complete table
+count_bk_calls(Name/Arity):-
+    functor(Head, Name, Arity),
+    bk_counter(calls, Name, Key),
+    wrap_predicate(Head, tabling_calls, Wrapped, (flag(Key, N, N + 1), Wrapped)).
+
+table_bk:-
+    forall(tabled_bk(PI), (table(PI), count_bk_calls(PI))).
+
+:- initialization(table_bk).
+
+% the tables of one example are of no use for the next, so they are counted and dropped after every example
+reset_bk_tables:-
+    forall(tabled_bk(Name/Arity),
+        (   functor(Head, Name, Arity),
+            aggregate_all(count, current_table(Head, _), Variants),
+            aggregate_all(count, (current_table(Head, Trie), trie_gen(Trie, _)), Answers),
+            bk_counter(variants, Name, VariantsKey),
+            flag(VariantsKey, V, V + Variants),
+            bk_counter(answers, Name, AnswersKey),
+            flag(AnswersKey, A, A + Answers)
+        )),
+    abolish_all_tables.
+
+% a call that does not start a new table is answered from an existing one
+bk_table_counts(Name, Calls, Hits, Answers):-
+    tabled_bk(Name/_),
+    bk_counter(calls, Name, CallsKey),
+    flag(CallsKey, Calls, Calls),
+    bk_counter(variants, Name, VariantsKey),
+    flag(VariantsKey, Variants, Variants),
+    bk_counter(answers, Name, AnswersKey),
+    flag(AnswersKey, Answers, Answers),
+    Hits is max(0, Calls - Variants).
@@ -0,0 +1,50 @@
+%%%%%%%%%% CHESS EXAMPLE LOADING %%%%%%%%%%
+
+:- dynamic chess_example/5.
+:- dynamic chess_example_legal_moves/2.
+:- dynamic chess_eval_timeout/1.
+
+% chess_example(ID, Pos, From, To, Label) holds the rendered example, and
+% chess_example_legal_moves(ID, [From-To, ...]) its legal moves when legal_move/3 is asserted rather than foreign
+
+%%%%%%%%%% CHESS EXAMPLE TESTING %%%%%%%%%%
+
+with_legal_moves(ID, Pos, Goal):-
+    chess_example_legal_moves(ID, Moves),!,
+    setup_call_cleanup(
+        forall(member(From-To, Moves), assertz(legal_move(From, To, Pos))),
+        Goal,
+        retractall(legal_move(_, _, _))).
+with_legal_moves(_, _, Goal):-
+    call(Goal).
+
+% Result is one of covered, uncovered or skipped (the query raised an exception, usually a timeout).
+% As in ChessTester.run_query, an example is covered when call_with_time_limit(T, f(Pos, From, To)) has exactly
+% one answer. call_with_time_limit/2 runs its goal as once/1, so that is whenever f/3 has a solution in time.
+test_chess_ex(ID, Result):-
+    chess_example(ID, Pos, From, To, _),
+    chess_eval_timeout(T),
+    with_legal_moves(ID, Pos,
+        catch((aggregate_all(count, call_with_time_limit(T, f(Pos, From, To)), N), (N =:= 1 -> Result = covered ; Result = uncovered)), _, Result = skipped)),
+    reset_example_tables.
+
+reset_example_tables:-
+    current_predicate(reset_bk_tables/0), !,
+    reset_bk_tables.
+reset_example_tables.
+
+chess_coverage(IDs, Covered, Skipped):-
+    findall(ID-Result, (member(ID, IDs), test_chess_ex(ID, Result)), Results),
+    findall(ID, member(ID-covered, Results), Covered),
+    findall(ID, member(ID-skipped, Results), Skipped).
+
+% stops at the first covered example
+chess_first_cover([], [], []).
+chess_first_cover([ID|IDs], Covered, Skipped):-
+    test_chess_ex(ID, Result),
+    (   Result == covered
+    ->  Covered = [ID], Skipped = []
+    ;   Result == skipped
+    ->  Skipped = [ID|Skipped1], chess_first_cover(IDs, Covered, Skipped1)
+    ;   chess_first_cover(IDs, Covered, Skipped)
+    ).
@@ -0,0 +1,189 @@
+import chess
+import numpy as np
+
+from .core import Clause
+from tactics.util import board_to_contents, successor
+
+SIDES = {chess.WHITE: 0, chess.BLACK: 1}
+SLIDING_PIECES = (chess.BISHOP, chess.ROOK, chess.QUEEN)
+
+# the relations that depend on a position, with their columns in the argument order of the bk predicate
+POSITION_RELATIONS = {
+    'legal_move': 3,
+    'attacks': 3,
+    'piece_at': 4,
+    'behind': 4,
+    'make_move': 4,
+}
+
+STATIC_RELATIONS = {
+    'different_pos': np.array([(s1, s2) for s1 in chess.SQUARES for s2 in chess.SQUARES if s1 != s2], dtype=np.int64),
+    'other_side': np.array([(0, 1), (1, 0)], dtype=np.int64),
+}
+
+def encode(*tables):
+    "Packs the columns of each table into one integer key per row, using the same radix for all of them"
+    keys = [np.zeros(len(table), dtype=np.int64) for table in tables]
+    num_columns = tables[0].shape[1]
+    for column in range(num_columns):
+        radix = 1 + max((int(table[:, column].max()) for table in tables if len(table)), default=0)
+        for key, table in zip(keys, tables):
+            key *= radix
+            key += table[:, column]
+    return keys
+
+def match(left, right):
+    "The pairs of row indices at which the rows of `left` and `right` are equal"
+    left_keys, right_keys = encode(left, right)
+    order = np.argsort(right_keys, kind='stable')
+    sorted_keys = right_keys[order]
+    start = np.searchsorted(sorted_keys, left_keys, side='left')
+    counts = np.searchsorted(sorted_keys, left_keys, side='right') - start
+    left_idx = np.repeat(np.arange(len(left)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_idx = order[np.repeat(start, counts) + offsets]
+    return left_idx, right_idx
+
+class BackendMismatchError(Exception):
+    "Raised by --check-backend when the NumPy backend and Prolog disagree on an example"
+
+class NumpyEvaluator:
+    """Tests single-clause programs with joins over the relations of every position, as Prolog would test them with
+    call_with_time_limit(T, f(Pos, From, To)) on the bk.pl rules, but without a time limit.
+
+    That goal runs as once/1, so an example is covered when the clause has any solution on it, and the relations are
+    kept as sets. Successors are built as the make_move/4 rule builds them. The legal moves of the example positions
+    are asserted, so a successor has no legal_move/3, attacks/3 or behind/4 facts and no successors of its own, unless
+    `foreign_legal_moves` is set: the foreign legal_move/3 of --fpred then decodes any contents list, which keeps no
+    en passant square, and finds the legal moves of every position, the successors included."""
+    def __init__(self, examples, ids, foreign_legal_moves=False):
+        self.foreign_legal_moves = foreign_legal_moves
+        self.ids = {}
+        self.boards = []
+        self.with_moves = set()
+        self.expanded = set()
+        self.rows = {name: [] for name in POSITION_RELATIONS}
+        self.tables = {}
+
+        # one row per example: its index, then the position, from and to squares of f/3
+        self.heads = np.full((len(examples), 4), -1, dtype=np.int64)
+        for i in ids:
+            example = examples[i]
+            self.heads[i] = (i, self.intern_example(example.board), example.move.from_square, example.move.to_square)
+
+    def intern_example(self, board):
+        if self.foreign_legal_moves:
+            decoded = board.copy(stack=False)
+            decoded.ep_square = None
+            return self.intern(board_to_contents(board), decoded, True)
+        # the EPD keeps the en passant square, which the asserted legal moves depend on
+        return self.intern(board.epd(), board, True)
+
+    def intern_successor(self, board, move):
+        child = successor(board, move)
+        contents = board_to_contents(child, set_castling_rights=True)
+        if self.foreign_legal_moves:
+            # the same contents list as an example position is the same position to the foreign predicate
+            return self.intern(contents, child, True)
+        return self.intern(('successor', contents), child, False)
+
+    def intern(self, key, board, with_moves):
+        if key not in self.ids:
+            pos_id = len(self.boards)
+            self.ids[key] = pos_id
+            self.boards.append(board)
+            if with_moves:
+                self.with_moves.add(pos_id)
+            self.add_relations(pos_id, board, with_moves)
+        return self.ids[key]
+
+    def add_relations(self, pos_id, board, with_moves):
+        # the same facts as the rules in bk.pl would derive, without their multiplicity
+        for square, piece in board.piece_map().items():
+            self.rows['piece_at'].append((square, pos_id, SIDES[piece.color], piece.piece_type))
+        self.tables = {}
+        if not with_moves:
+            return
+        moves = sorted({(move.from_square, move.to_square) for move in board.legal_moves})
+        self.rows['legal_move'].extend((from_sq, to_sq, pos_id) for from_sq, to_sq in moves)
+        attacked = {}
+        for from_sq, to_sq in moves:
+            piece = board.piece_at(from_sq)
+            target = board.piece_at(to_sq)
+            if target and target.color != piece.color:
+                self.rows['attacks'].append((from_sq, to_sq, pos_id))
+                attacked.setdefault(from_sq, []).append(to_sq)
+        for front, targets in attacked.items():
+            if board.piece_type_at(front) in SLIDING_PIECES:
+                self.rows['behind'].extend((front, middle, back, pos_id) for middle in targets for back in targets)
+
+    def expand(self, pos_ids):
+        "Adds the make_move/4 rows of the given positions, interning their successors"
+        for pos_id in pos_ids:
+            # make_move/4 needs legal_move/3, so a position without legal moves has no successors
+            if pos_id in self.expanded or pos_id not in self.with_moves:
+                continue
+            self.expanded.add(pos_id)
+            board = self.boards[pos_id]
+            for move in board.legal_moves:
+                succ_id = self.intern_successor(board, move)
+                self.rows['make_move'].append((move.from_square, move.to_square, pos_id, succ_id))
+            self.tables = {}
+
+    def relation(self, name):
+        if name in STATIC_RELATIONS:
+            return STATIC_RELATIONS[name]
+        if name not in self.tables:
+            self.tables[name] = np.array(self.rows[name], dtype=np.int64).reshape(-1, POSITION_RELATIONS[name])
+        return self.tables[name]
+
+    def join(self, bindings, columns, literal):
+        "Extends every binding with the rows of the literal's relation that agree with it, dropping the others"
+        if literal.predicate == 'make_move':
+            # the rule starts with \+ ground(NewPos), so it fails when the new position is already bound
+            if literal.arguments[3] in columns:
+                return bindings[:0]
+            self.expand(np.unique(bindings[:, columns[literal.arguments[2]]]).tolist())
+        table = self.relation(literal.predicate)
+
+        bound = [(i, columns[arg]) for i, arg in enumerate(literal.arguments) if arg in columns]
+        new = {}
+        for i, arg in enumerate(literal.arguments):
+            if arg in columns:
+                continue
+            if arg in new:
+                # a new variable that occurs twice only matches rows with equal values in both places
+                table = table[table[:, new[arg]] == table[:, i]]
+            else:
+                new[arg] = i
+
+        binding_idx, table_idx = match(bindings[:, [c for _, c in bound]], table[:, [i for i, _ in bound]])
+        bindings = np.hstack([bindings[binding_idx], table[table_idx][:, list(new.values())]])
+        for k, arg in enumerate(new):
+            columns[arg] = bindings.shape[1] - len(new) + k
+        # only whether an example has a binding matters, so duplicates can go
+        return np.unique(bindings, axis=0)
+
+    def clause_coverage(self, clause, ids):
+        head, body = Clause.to_ordered(clause)
+        bindings = self.heads[ids]
+        columns = {}
+        for i, arg in enumerate(head.arguments):
+            if arg in columns:
+                bindings = bindings[bindings[:, columns[arg]] == bindings[:, i + 1]]
+            else:
+                columns[arg] = i + 1
+        for literal in body:
+            if len(bindings) == 0:
+                break
+            bindings = self.join(bindings, columns, literal)
+        return np.unique(bindings[:, 0]).tolist()
+
+    def coverage(self, rules, ids):
+        "Returns a mask of the examples in `ids` that the program covers, testing them all at once"
+        ids = np.array(list(ids), dtype=np.int64)
+        covered = 0
+        for rule in rules:
+            for i in self.clause_coverage(rule, ids):
+                covered |= 1 << i
+        return covered
@@ -5,6 +5,7 @@ import os
 import logging
 import json
 import inspect
+import math
 from time import perf_counter
 from contextlib import contextmanager
 from .core import Clause
@@ -15,12 +16,24 @@ EVAL_TIMEOUT=0.001
 MAX_LITERALS=100
 MAX_SOLUTIONS=1
 CLINGO_ARGS=''
+TEST_WORKERS=1
+TEST_CHUNK=1
+SEARCH_WORKERS=1
+# durations are counted in buckets that grow by DURATION_GROWTH from DURATION_MIN seconds, so a
+# quantile is within 5% of the true one for any duration between a tenth of a microsecond and three hours
+DURATION_MIN=1e-7
+DURATION_GROWTH=1.1
+DURATION_BUCKETS=270
+FLUSH_LIMIT=1000
+CHECKPOINT_INTERVAL=600
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Popper, an ILP engine based on learning from failures')
     parser.add_argument('kbpath', help = 'Path to the knowledge base one wants to learn on')
     parser.add_argument('--eval-timeout', type=float, default=EVAL_TIMEOUT, help='Prolog evaluation timeout in seconds')
     parser.add_argument('--timeout', type=float, default=TIMEOUT, help='Overall timeout (in seconds)')
+    parser.add_argument('--anytime', default=False, action='store_true', help='Stop the search when --timeout runs out and output the tactics found so far')
+    parser.add_argument('--split-budget', default=False, action='store_true', help='With --anytime, share the time left evenly between the program sizes left that the bias allows, moving on to the next size when a size has used its share')
     parser.add_argument('--max-literals', type=int, default=MAX_LITERALS, help='Maximum number of literals allowed in program')
     # parser.add_argument('--max-solutions', type=int, default=MAX_SOLUTIONS, help='Maximum number of solutions to print')
     parser.add_argument('--test-all', default=False, action='store_true', help='Test all examples')
@@ -35,6 +48,27 @@ def parse_args():
     parser.add_argument('--bias-file', type=str, default='', help='Filename for the bias')
     parser.add_argument('--stats-file', type=str, default='', help='Filename for outputting execution statistics as json')
     parser.add_argument('--fpred', default=False, action='store_true', help='Use legal_move as a foreign predicate')
+    parser.add_argument('--intern-positions', default=False, action='store_true', help='Assert each example position and its legal moves once under an integer ID')
+    parser.add_argument('--materialise', default=False, action='store_true', help='Precompute attacks, piece_at and behind for each example position (implies --intern-positions)')
+    parser.add_argument('--successor-table', default=False, action='store_true', help='Precompute the make_move successors of each example position (implies --intern-positions)')
+    parser.add_argument('--flush-policy', choices=['fixed', 'adaptive'], default='fixed', help='Add buffered constraints to the solver at --flush-limit, or as soon as the programs they would prune cost more than a restart')
+    parser.add_argument('--flush-limit', type=int, default=FLUSH_LIMIT, help='Most constraint sets to buffer before adding them to the solver')
+    parser.add_argument('--flush-continue', default=False, action='store_true', help='Banish valid programs when flushing, so that the solver does not return them again')
+    parser.add_argument('--checkpoint', type=str, default='', help='File to which to save the state of the search, so that it can be resumed')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL, help='Least number of seconds between two checkpoints within a program size')
+    parser.add_argument('--resume', default=False, action='store_true', help='Resume the search from the --checkpoint file')
+    parser.add_argument('--grounding-cache', type=str, default='', help='File in which to keep the variable bindings of constraints across runs')
+    parser.add_argument('--test-backend', choices=['prolog', 'numpy'], default='prolog', help='Test programs with Prolog or with NumPy joins over precomputed relations')
+    parser.add_argument('--check-backend', default=False, action='store_true', help='Also test every program with Prolog, raise BackendMismatchError if the NumPy backend disagrees on an example Prolog did not time out on, and count those timeouts as skipped')
+    parser.add_argument('--profile-bk', default=False, action='store_true', help='Profile the background knowledge predicates with the SWI-Prolog profiler and show the time spent in each')
+    parser.add_argument('--table-bk', default=False, action='store_true', help='Table attacks, piece_at and behind while testing an example (drops their duplicate answers, which does not change coverage)')
+    parser.add_argument('--bitboards', default=False, action='store_true', help='Encode positions as bitboards (uses bk_bitboard.pl unless --bk-file is given)')
+    parser.add_argument('--batch-test', default=False, action='store_true', help='Load the examples into Prolog once and test each program with a single query')
+    parser.add_argument('--early-test', default=False, action='store_true', help='Stop testing a program at its first covered example, and skip the examples that a tested generalisation of it does not cover (--debug still logs complete counts)')
+    parser.add_argument('--pipeline', type=int, default=0, help='Test up to this many programs in --test-workers background processes while the solver generates more (ignores --test-chunk)')
+    parser.add_argument('--test-chunk', type=int, default=TEST_CHUNK, help='Number of programs to test together, one example at a time (finds the same valid tactics, but may test a different number of programs)')
+    parser.add_argument('--test-workers', type=int, default=TEST_WORKERS, help='Number of processes to split the examples across when testing a program')
+    parser.add_argument('--search-workers', type=int, default=SEARCH_WORKERS, help='Number of processes to split the hypothesis space across, each searching the programs whose first two body literals are dealt to it')
     return parser.parse_args()
 
 def timeout(func, args=(), kwargs={}, timeout_duration=1, default=None):
@@ -67,6 +101,8 @@ def parse_settings():
     args = parse_args()
     
     (bk_file, ex_file, bias_file) = load_kbpath(args.kbpath)
+    if args.bitboards:
+        bk_file = fix_path(args.kbpath, "bk_bitboard.pl")
 
     return Settings(
         args.bias_file if args.bias_file else bias_file,
@@ -79,12 +115,35 @@ def parse_settings():
         eval_timeout = args.eval_timeout,
         test_all = args.test_all,
         timeout = args.timeout,
+        anytime = args.anytime,
+        split_budget = args.split_budget,
         max_literals = args.max_literals,
         clingo_args= [] if not args.clingo_args else args.clingo_args.split(' '),
         max_solutions = MAX_SOLUTIONS,
         functional_test = args.functional_test,
         hspace = False if args.hspace == -1 else args.hspace,
-        fpred = args.fpred
+        fpred = args.fpred,
+        intern_positions = args.intern_positions,
+        materialise = args.materialise,
+        successor_table = args.successor_table,
+        bitboards = args.bitboards,
+        table_bk = args.table_bk,
+        profile_bk = args.profile_bk,
+        flush_policy = args.flush_policy,
+        flush_limit = args.flush_limit,
+        flush_continue = args.flush_continue,
+        checkpoint_file = args.checkpoint if args.checkpoint else None,
+        checkpoint_interval = args.checkpoint_interval,
+        resume = args.resume,
+        grounding_cache = args.grounding_cache if args.grounding_cache else None,
+        test_backend = args.test_backend,
+        check_backend = args.check_backend,
+        batch_test = args.batch_test,
+        early_test = args.early_test,
+        test_workers = args.test_workers,
+        test_chunk = args.test_chunk,
+        pipeline = args.pipeline,
+        search_workers = args.search_workers
     )
 
 class Settings:
@@ -99,12 +158,35 @@ class Settings:
             eval_timeout = EVAL_TIMEOUT,
             test_all = False,
             timeout = TIMEOUT,
+            anytime = False,
+            split_budget = False,
             max_literals = MAX_LITERALS,
             clingo_args = CLINGO_ARGS,
             max_solutions = MAX_SOLUTIONS,
             functional_test = False,
             hspace=False,
-            fpred=False):
+            fpred=False,
+            intern_positions=False,
+            materialise=False,
+            successor_table=False,
+            bitboards=False,
+            table_bk=False,
+            profile_bk=False,
+            flush_policy='fixed',
+            flush_limit=FLUSH_LIMIT,
+            flush_continue=False,
+            checkpoint_file=None,
+            checkpoint_interval=CHECKPOINT_INTERVAL,
+            resume=False,
+            grounding_cache=None,
+            test_backend='prolog',
+            check_backend=False,
+            batch_test=False,
+            early_test=False,
+            test_workers=TEST_WORKERS,
+            test_chunk=TEST_CHUNK,
+            pipeline=0,
+            search_workers=SEARCH_WORKERS):
             
         self.bias_file = bias_file
         self.ex_file = ex_file
@@ -116,12 +198,37 @@ class Settings:
         self.eval_timeout = eval_timeout
         self.test_all = test_all
         self.timeout = timeout
+        self.anytime = anytime
+        self.split_budget = split_budget
+        # set when the search starts
+        self.deadline = None
         self.max_literals = max_literals
         self.clingo_args = clingo_args
         self.max_solutions = max_solutions
         self.functional_test = functional_test
         self.hspace = hspace
         self.fpred = fpred
+        self.intern_positions = intern_positions
+        self.materialise = materialise
+        self.successor_table = successor_table
+        self.bitboards = bitboards
+        self.table_bk = table_bk
+        self.profile_bk = profile_bk
+        self.flush_policy = flush_policy
+        self.flush_limit = flush_limit
+        self.flush_continue = flush_continue
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.grounding_cache = grounding_cache
+        self.test_backend = test_backend
+        self.check_backend = check_backend
+        self.batch_test = batch_test
+        self.early_test = early_test
+        self.test_workers = test_workers
+        self.test_chunk = test_chunk
+        self.pipeline = pipeline
+        self.search_workers = search_workers
 
 def format_program(program):
     return "\n".join(Clause.to_code(Clause.to_ordered(clause)) + '.' for clause in program)
@@ -148,7 +255,9 @@ class Stats:
                     stages = None,
                     best_programs = None,
                     solution = None,
-                    stats_file = None):
+                    stats_file = None,
+                    counters = None,
+                    bk_profile = None):
         self.exec_start = perf_counter()
         self.logger = logging.getLogger("popper")
 
@@ -163,6 +272,8 @@ class Stats:
         self.best_programs = [] if not best_programs else best_programs
         self.solution = solution
         self.stats_file = stats_file
+        self.counters = {} if not counters else counters
+        self.bk_profile = {} if not bk_profile else bk_profile
 
     def __enter__(self):
         return self
@@ -239,6 +350,30 @@ class Stats:
     def register_ground_rules(self, rules):
         self.total_ground_rules += len(rules)
 
+    def merge(self, other):
+        "Adds the totals of a search that ran in another process"
+        self.total_programs += other.total_programs
+        self.total_rules += other.total_rules
+        self.total_ground_rules += other.total_ground_rules
+        for operation, durations in other.durations.items():
+            self.durations.setdefault(operation, DurationAccumulator()).merge(durations)
+        self.best_programs.extend(other.best_programs)
+        if not self.solution:
+            self.solution = other.solution
+        self.register_counters(other.counters)
+        self.register_bk_profile(other.bk_profile)
+
+    def register_counters(self, counters):
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register_bk_profile(self, profile):
+        if not profile:
+            return
+        # the profiler lives with the rest of the Prolog helpers, which only --profile-bk needs
+        from tactics.util import merge_bk_profiles
+        merge_bk_profiles(self.bk_profile, profile)
+
     @property
     def best_program(self):
         if self.solution:
@@ -256,21 +391,24 @@ class Stats:
         for summary in self.duration_summary():
             message += f'{summary.operation}:\n\tCalled: {summary.called} times \t ' + \
                        f'Total: {summary.total:0.2f} \t Mean: {summary.mean:0.3f} \t ' + \
-                       f'Max: {summary.maximum:0.3f}\n'
+                       f'Min: {summary.minimum:0.3f} \t Max: {summary.maximum:0.3f}\n' + \
+                       f'\tP50: {summary.p50:0.4f} \t P95: {summary.p95:0.4f} \t P99: {summary.p99:0.4f}\n'
             if summary.operation != 'basic setup':
                 total_op_time += summary.total
         message += f'Total operation time: {total_op_time:0.2f}s\n'
+        for name, value in self.counters.items():
+            message += f'{name}: {value}\n'
+        if self.bk_profile:
+            from tactics.util import format_bk_profile
+            message += f'{format_bk_profile(self.bk_profile)}\n'
         message += f'Total execution time: {self.total_exec_time():0.2f}s'
         self.logger.info(message)
 
     def duration_summary(self):
         summary = []
         for operation, durations in self.durations.items():
-            called = len(durations)
-            total = sum(durations)
-            mean = sum(durations)/len(durations)
-            maximum = max(durations)
-            summary.append(DurationSummary(operation.title(), called, total, mean, maximum))
+            summary.append(DurationSummary(operation.title(), durations.count, durations.total, durations.mean(), durations.maximum,
+                                           durations.minimum, durations.quantile(0.5), durations.quantile(0.95), durations.quantile(0.99)))
         return summary
 
     @contextmanager
@@ -280,12 +418,12 @@ class Stats:
             yield
         finally:
             end = perf_counter()
-            duration = end - start
+            self.register_duration(operation, end - start)
 
-            if operation not in self.durations:
-                self.durations[operation] = [duration]
-            else:
-                self.durations[operation].append(duration)
+    def register_duration(self, operation, duration):
+        if operation not in self.durations:
+            self.durations[operation] = DurationAccumulator()
+        self.durations[operation].add(duration)
 
 class Stage:
     def __init__(self, num_literals, total_programs, programs, total_exec_time, exec_time):
@@ -303,16 +441,68 @@ class ProgramStats:
         self.total_exec_time = total_exec_time
         self.durations = durations
         
+class DurationAccumulator:
+    "The count, total, extremes and a histogram of the durations of an operation, in constant space"
+    def __init__(self, count=0, total=0.0, minimum=0.0, maximum=0.0, buckets=None):
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.buckets = [0] * DURATION_BUCKETS if not buckets else buckets
+
+    @staticmethod
+    def bucket(duration):
+        if duration <= DURATION_MIN:
+            return 0
+        return min(DURATION_BUCKETS - 1, 1 + int(math.log(duration / DURATION_MIN, DURATION_GROWTH)))
+
+    def add(self, duration):
+        self.minimum = duration if not self.count else min(self.minimum, duration)
+        self.maximum = max(self.maximum, duration)
+        self.count += 1
+        self.total += duration
+        self.buckets[self.bucket(duration)] += 1
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.minimum = other.minimum if not self.count else min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.count += other.count
+        self.total += other.total
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        "The duration below which a fraction `q` of the durations fall, to within the width of a bucket"
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                break
+        # the middle of the bucket, on the same log scale as its bounds
+        estimate = DURATION_MIN * DURATION_GROWTH ** (i - 0.5) if i else DURATION_MIN
+        return min(self.maximum, max(self.minimum, estimate))
+
 class DurationSummary:
-    def __init__(self, operation, called, total, mean, maximum):
+    def __init__(self, operation, called, total, mean, maximum, minimum=0.0, p50=0.0, p95=0.0, p99=0.0):
         self.operation = operation
         self.called = called
         self.total = total
         self.mean = mean
         self.maximum = maximum
+        self.minimum = minimum
+        self.p50 = p50
+        self.p95 = p95
+        self.p99 = p99
 
 TYPE = '__type__'
-WRITABLE_CLASSES = {Stats, Stage, ProgramStats, DurationSummary}
+WRITABLE_CLASSES = {Stats, Stage, ProgramStats, DurationAccumulator, DurationSummary}
 NAME_TO_CLASS = {clz.__name__:clz for clz in WRITABLE_CLASSES}
 
 # TODO (Brad): Let's improve this and use real json encoding.
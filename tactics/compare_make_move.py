@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+from collections import Counter
+
+import chess
+
+from util import *
+
+SUCCESSORS_QUERY = 'findall(From-To-Sorted, (make_move(From, To, {position}, NewPos), position_list(NewPos, List), msort(List, Sorted)), Successors)'
+
+# the tactics in bk.pl, which test attacks/3 and behind/4 on the position after a move
+BK_TACTICS = ['f(A,B,C):-fork(A,B,C)', 'f(A,B,C):-pin(A,B,C)']
+
+def successors(prolog, position: str) -> Counter:
+    "The multiset of (from, to, position list) successors that make_move/4 finds for a position"
+    result = next(prolog.query(SUCCESSORS_QUERY.format(position=position)))
+    return Counter(str(successor) for successor in result['Successors'])
+
+def time_make_move(prolog, position: str, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        list(prolog.query(f'findall(NewPos, make_move(_, _, {position}, NewPos), _)'))
+    return time.perf_counter() - start
+
+def read_tactics(tactics_file: str) -> List[str]:
+    "The clauses of a file of learned tactics, one per line as Popper prints them"
+    with open(tactics_file) as tactics_handle:
+        return [line.strip().rstrip('.') for line in tactics_handle if line.startswith('f(')]
+
+def covers(prolog, tactic: str, board: chess.Board, move: chess.Move, interner: Optional[PositionInterner]=None) -> Optional[bool]:
+    "Whether a tactic covers an example, or None if its query failed"
+    results = chess_query(prolog, tactic, board, limit=1, move=move, interner=interner)
+    return None if results is None else bool(results)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the make_move/4 rule against the precomputed successor table')
+    parser.add_argument('ex_file', type=str, help='CSV file of examples, e.g. tactics/data/exs/examples_train.csv')
+    parser.add_argument('--tactics-file', type=str, default=None, help='File of learned tactics to compare the coverage of, as well as fork/3 and pin/3 from bk.pl')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of times to enumerate the successors of each position')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    examples = [(board, move) for board, move, _ in chess_examples(args.ex_file)]
+    boards = [board for board, _ in examples]
+    tactics = BK_TACTICS + (read_tactics(args.tactics_file) if args.tactics_file else [])
+
+    prolog = get_prolog(BK_FILE)
+    rule_time = 0.0
+    rule_successors = []
+    for board in boards:
+        with assert_legal_moves(prolog, board):
+            position = fen_to_contents(board.fen())
+            rule_time += time_make_move(prolog, position, args.repeat)
+            rule_successors.append(successors(prolog, position))
+    rule_coverage = [[covers(prolog, tactic, board, move) for board, move in examples] for tactic in tactics]
+
+    interner = PositionInterner(prolog, successors=True)
+    start = time.perf_counter()
+    ids = [interner.intern(board) for board in boards]
+    intern_time = time.perf_counter() - start
+    table_time = 0.0
+    mismatches = 0
+    for pos_id, expected in zip(ids, rule_successors):
+        table_time += time_make_move(prolog, pos_id, args.repeat)
+        if successors(prolog, pos_id) != expected:
+            mismatches += 1
+    table_coverage = [[covers(prolog, tactic, board, move, interner) for board, move in examples] for tactic in tactics]
+
+    print(f'positions: {len(boards)}, distinct interned positions: {len(interner.ids)}, successors: {len(interner.successor_positions)}')
+    print(f'make_move rule: {rule_time:.3f}s for {args.repeat} enumerations of each position')
+    print(f'successor table: {table_time:.3f}s for {args.repeat} enumerations of each position, plus {intern_time:.3f}s to build it')
+    print(f'positions with different successors: {mismatches}')
+    for tactic, rule_covered, table_covered in zip(tactics, rule_coverage, table_coverage):
+        differ = sum(rule != table for rule, table in zip(rule_covered, table_covered))
+        print(f'{tactic}: covers {sum(map(bool, rule_covered))} examples with the rule, {sum(map(bool, table_covered))} with the table, {differ} differ')
+
+if __name__ == '__main__':
+    main()
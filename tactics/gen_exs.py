@@ -1,13 +1,14 @@
 import argparse
 import csv
 import random
+from contextlib import ExitStack
 from typing import List, Optional, TextIO
 
 import chess
 import chess.engine
 import chess.pgn
 
-from util import LICHESS_2013, STOCKFISH, PathLike, get_engine, get_top_n_moves
+from util import LICHESS_2013, STOCKFISH, EvalCache, PathLike, engine_identity, get_engine, get_top_n_moves_many
 
 
 def sample_pgn(handle: TextIO, num_games: int=10, pos_per_game: int=10, middle_game_cutoff: Optional[int]=None) -> List[chess.Board]:
@@ -55,20 +56,22 @@ def sample_pgn(handle: TextIO, num_games: int=10, pos_per_game: int=10, middle_g
     print(len(result))
     return result
 
-def gen_exs(exs_pgn_path: PathLike, num_games: int=10, pos_per_game: int=10, neg_to_pos_ratio: int=0, use_engine: bool=False, engine_path: Optional[PathLike]=None, middle_game_cutoff: Optional[int]=False):
+def gen_exs(exs_pgn_path: PathLike, num_games: int=10, pos_per_game: int=10, neg_to_pos_ratio: int=0, use_engine: bool=False, engine_path: Optional[PathLike]=None, middle_game_cutoff: Optional[int]=False, eval_cache: Optional[PathLike]=None, engine_workers: int=1):
     
     with open(exs_pgn_path) as handle:
         sample_examples = sample_pgn(handle, num_games=num_games, pos_per_game=pos_per_game, middle_game_cutoff=middle_game_cutoff)
     
     if use_engine:
-        with get_engine(engine_path) as engine:
-            for position, move in sample_examples:
-                moves = get_top_n_moves(engine, position, neg_to_pos_ratio + 1)
+        with get_engine(engine_path, engine_workers) as engine, ExitStack() as stack:
+            cache = stack.enter_context(EvalCache(eval_cache, engine_identity(engine, engine_path))) if eval_cache else None
+            positions = [position for position, _ in sample_examples]
+            # every sampled position is analysed in one batch, which an engine pool spreads over its engines
+            for position, moves in zip(positions, get_top_n_moves_many(engine, positions, neg_to_pos_ratio + 1, cache=cache)):
                 if not moves:
                     continue
-                _, top_move = moves[0]
+                top_move = moves[0]
                 yield {'fen': position.fen(), 'uci': top_move.uci(), 'label': 1}
-                for _, move in moves[1:]:
+                for move in moves[1:]:
                     yield {'fen': position.fen(), 'uci': move.uci(), 'label': 0}
     else:
         for position, move in sample_examples:
@@ -84,6 +87,8 @@ def parse_args():
     parser.add_argument('-r', '--ratio', dest='neg_to_pos_ratio', type=int, default=3, help='Ratio of negative to positive examples to generate')
     parser.add_argument('--seed', dest='seed', type=int, default=1, help='Seed to use for random generation')
     parser.add_argument('--use-engine', action='store_true', help='Use engine to generate moves for the examples')
+    parser.add_argument('--engine-workers', dest='engine_workers', type=int, default=1, help='Number of engine processes to analyse positions with concurrently')
+    parser.add_argument('--eval-cache', dest='eval_cache', type=str, default=None, help='SQLite file in which to keep engine analyses between runs')
     parser.add_argument('--middle-game-cutoff', dest='middle_game_cutoff', type=int, default=None, help='Cut-off first and last N examples in  game to sample from')
     return parser.parse_args()
 
@@ -95,7 +100,7 @@ def main():
         field_names = ['fen', 'uci', 'label']
         writer = csv.DictWriter(output, fieldnames=field_names)
         writer.writeheader()
-        for ex in gen_exs(args.pgn_file, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.use_engine, args.engine_path, args.middle_game_cutoff):
+        for ex in gen_exs(args.pgn_file, args.num_games, args.pos_per_game, args.neg_to_pos_ratio, args.use_engine, args.engine_path, args.middle_game_cutoff, args.eval_cache, args.engine_workers):
             writer.writerow(ex)
 
 if __name__ == '__main__':
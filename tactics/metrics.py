@@ -3,14 +3,16 @@ import csv
 import logging
 import math
 from collections.abc import Callable
-from typing import Generator, List, Optional, Tuple
+from contextlib import ExitStack, contextmanager, nullcontext
+from itertools import islice
+from typing import Generator, Iterable, List, Optional, Tuple
 
 import chess
 import chess.engine
 import chess.pgn
 import pyparsing
 from pyswip import Prolog
-from pyswip.prolog import Prolog
+from pyswip.prolog import Prolog, PrologError
 from tqdm import tqdm
 
 from prolog_parser import create_parser, parse_result_to_str
@@ -19,6 +21,10 @@ from util import *
 logger = logging.getLogger(__name__)
 logger.propagate = False # https://stackoverflow.com/a/2267567
 
+SUGGESTIONS_PER_TACTIC = 3
+# positions whose engine analyses are sent together, enough to keep an engine pool busy while still showing progress
+WARM_BATCH_SIZE = 256
+
 def evaluate(evaluated_suggestions: List[Tuple[chess.Move, int]], top_moves: List[Tuple[chess.Move, int]], metric_fn: Callable[[int, float], float]) -> float:
     "Calculate a metric by comparing a given list of evaluated moves to the top recommended moves"
     metric: float = 0
@@ -29,10 +35,8 @@ def evaluate(evaluated_suggestions: List[Tuple[chess.Move, int]], top_moves: Lis
         metric += metric_fn(idx, error)
     return metric / len(evaluated_suggestions)
 
-def get_tactic_match(prolog: Prolog, text: str, board: chess.Board, limit: int=3, time_limit_sec: Optional[int]=None, use_foreign_predicate: bool=False) -> Tuple[Optional[bool], Optional[List[chess.Move]]]:
-    "Given the text of a Prolog-based tactic, and a position, check whether the tactic matched in the given position or and if so, what were the suggested moves"
-    
-    results = chess_query(prolog, text, board, limit=limit, time_limit_sec=time_limit_sec, use_foreign_predicate=use_foreign_predicate)
+def results_to_match(results: Optional[list]) -> Tuple[Optional[bool], Optional[List[chess.Move]]]:
+    "Convert the results of a tactic query into whether the tactic matched and the moves it suggested"
     if results is None:
         match, suggestions = None, None
     elif not results:
@@ -48,6 +52,12 @@ def get_tactic_match(prolog: Prolog, text: str, board: chess.Board, limit: int=3
     
     return match, suggestions
 
+def get_tactic_match(prolog: Prolog, text: str, board: chess.Board, limit: int=3, time_limit_sec: Optional[int]=None, use_foreign_predicate: bool=False, interner: Optional[PositionInterner]=None) -> Tuple[Optional[bool], Optional[List[chess.Move]]]:
+    "Given the text of a Prolog-based tactic, and a position, check whether the tactic matched in the given position or and if so, what were the suggested moves"
+    
+    results = chess_query(prolog, text, board, limit=limit, time_limit_sec=time_limit_sec, use_foreign_predicate=use_foreign_predicate, interner=interner)
+    return results_to_match(results)
+
 def print_metrics(metrics: dict, log_level=logging.INFO, **kwargs) -> None:
     tactic_text = kwargs['tactic_text']
     logger.log(log_level, f"Tactic: {tactic_text}")
@@ -61,7 +71,6 @@ def print_metrics(metrics: dict, log_level=logging.INFO, **kwargs) -> None:
     logger.log(log_level, f"Average = {metrics['avg']:.2f}")
     logger.log(log_level, f"# of correct move suggestions = {metrics['correct_move']}")
 
-@contextmanager
 def write_metrics(metrics_list: List[dict], csv_filename: str) -> None:
     "Write metrics to csv file for analysis"
     with open(csv_filename, 'w') as csv_file:
@@ -71,9 +80,8 @@ def write_metrics(metrics_list: List[dict], csv_filename: str) -> None:
         for metrics in metrics_list:
             writer.writerow(metrics)
 
-def calc_metrics(prolog, tactic_text: str, engine: chess.engine.SimpleEngine, positions: Generator[chess.Board, None, None], settings) -> Optional[dict]:
-    SUGGESTIONS_PER_TACTIC = 3
-    metrics = {
+def new_metrics() -> dict:
+    return {
         'total_positions': 0, # total number of positions (across all games)
         'total_matches': 0,
         'divergence': 0.0,
@@ -86,44 +94,153 @@ def calc_metrics(prolog, tactic_text: str, engine: chess.engine.SimpleEngine, po
         'best_move_evals': 0
     }
 
+def position_evals(engine: chess.engine.SimpleEngine, board: chess.Board, move: chess.Move, settings, cache: Optional[EvalCache]=None) -> Tuple[List[Tuple[chess.Move, int]], List[Tuple[chess.Move, int]]]:
+    "Evaluate the ground-truth move and the engine's best move of a position, which are the same for every tactic"
+    ground_evals = evaluate_moves(engine, board, [move], mate_score=settings.mate_score, cache=cache)
+    best_moves = get_top_n_moves(engine, board, 1, cache=cache)
+    best_move_evals = evaluate_moves(engine, board, best_moves[:1], mate_score=settings.mate_score, cache=cache)
+    return ground_evals, best_move_evals
+
+def update_metrics(metrics: dict, engine: chess.engine.SimpleEngine, board: chess.Board, move: chess.Move, match: bool, suggestions: Optional[List[chess.Move]], evals: tuple, settings, cache: Optional[EvalCache]=None) -> None:
+    "Add the outcome of a tactic in a position to the tactic's metrics"
     divergence_fn = lambda idx, error: error / math.log2(1 + (idx + 1))
     avg_fn = lambda _, error: error
 
-    with tqdm(desc='Positions', unit='positions', leave=False) as pos_progress_bar:
-        for board, move, label in positions:
-            logger.debug(board)
-            match, suggestions = get_tactic_match(prolog, tactic_text, board, limit=SUGGESTIONS_PER_TACTIC, time_limit_sec=settings.eval_timeout, use_foreign_predicate=settings.fpred)
-            if match is None: # skip position for which we timeout
-                continue
-            logger.debug(f'Suggestions: {suggestions}')
-
-            metrics['total_positions'] += 1
-
-            ground_evals = get_evals(engine, board, [move], mate_score=settings.mate_score)
-            best_moves = get_top_n_moves(engine, board, 1)
-            best_move_evals = get_evals(engine, board, best_moves[:1], mate_score=settings.mate_score)
-            metrics['ground_evals'] += ground_evals[0][1]
-            metrics['best_move_evals'] += best_move_evals[0][1]
+    metrics['total_positions'] += 1
+
+    ground_evals, best_move_evals = evals
+    metrics['ground_evals'] += ground_evals[0][1]
+    metrics['best_move_evals'] += best_move_evals[0][1]
+    
+    if match:
+        metrics['total_matches'] += 1
+        if suggestions:
+            if move in suggestions:
+                metrics['correct_move'] += 1
+            tactic_evals = evaluate_moves(engine, board, suggestions, mate_score=settings.mate_score, cache=cache)
+            metrics['divergence'] += evaluate(tactic_evals, ground_evals, divergence_fn)
+            metrics['avg'] += evaluate(tactic_evals, ground_evals, avg_fn)
+            metrics['num_suggestions'] += len(suggestions)
+            metrics['tactic_evals'] += tactic_evals[0][1]
             
-            if match:
-                metrics['total_matches'] += 1
-                if suggestions:
-                    if move in suggestions:
-                        metrics['correct_move'] += 1
-                    tactic_evals = get_evals(engine, board, suggestions, mate_score=settings.mate_score)
-                    metrics['divergence'] += evaluate(tactic_evals, ground_evals, divergence_fn)
-                    metrics['avg'] += evaluate(tactic_evals, ground_evals, avg_fn)
-                    metrics['num_suggestions'] += len(suggestions)
-                    metrics['tactic_evals'] += tactic_evals[0][1]
-                    
-            else:
-                logger.debug(f'Updated empty suggestions')
-                metrics['empty_suggestions'] += 1
-            pos_progress_bar.update(1)
+    else:
+        logger.debug(f'Updated empty suggestions')
+        metrics['empty_suggestions'] += 1
+
+def windows(positions: Iterable, size: int) -> Generator[list, None, None]:
+    "Split positions into lists of `size`, the last one possibly shorter"
+    positions = iter(positions)
+    while window := list(islice(positions, size)):
+        yield window
+
+@contextmanager
+def window_cache(cache: Optional[EvalCache]) -> Generator[EvalCache, None, None]:
+    "The cache to analyse a window of positions into, which is an in-memory one for the window if no cache is given"
+    if cache is not None:
+        yield cache
+        return
+    with EvalCache(':memory:', '') as memory_cache:
+        yield memory_cache
+
+def analyse_positions(engine: chess.engine.SimpleEngine, positions: List[Tuple[chess.Board, chess.Move, List[chess.Move]]], cache: EvalCache) -> None:
+    "Analyse everything the metrics of (board, ground-truth move, suggested moves) positions need into a cache, in two batches that an engine pool spreads over its engines"
+    best_moves = get_top_n_moves_many(engine, [board for board, _, _ in positions], 1, cache=cache)
+    boards = []
+    for (board, move, suggestions), best in zip(positions, best_moves):
+        boards.append(board)
+        for evaluated_move in dict.fromkeys([move] + best[:1] + suggestions):
+            tmp_board = board.copy(stack=False)
+            tmp_board.push(evaluated_move)
+            if tmp_board.outcome() is None:
+                boards.append(tmp_board)
+    get_scores(engine, boards, cache)
+
+def warm_eval_cache(engine: chess.engine.SimpleEngine, positions: Generator[chess.Board, None, None], settings, cache: EvalCache) -> None:
+    "Analyse the ground-truth and best moves of every position ahead of time, since they are the same for every tactic"
+    positions = list(positions)
+    with tqdm(total=len(positions), desc='Warming', unit='positions', leave=False) as progress_bar:
+        for window in windows(positions, WARM_BATCH_SIZE):
+            analyse_positions(engine, [(board, move, []) for board, move, _ in window], cache)
+            progress_bar.update(len(window))
+
+def calc_metrics(prolog, tactic_text: str, engine: chess.engine.SimpleEngine, positions: Generator[chess.Board, None, None], settings, interner: Optional[PositionInterner]=None, cache: Optional[EvalCache]=None) -> Optional[dict]:
+    metrics = new_metrics()
+
+    with tqdm(desc='Positions', unit='positions', leave=False) as pos_progress_bar:
+        # the tactic is matched in a window of positions first, so that the engine analyses all of them in one go
+        for window in windows(positions, WARM_BATCH_SIZE):
+            matched = []
+            for board, move, label in window:
+                logger.debug(board)
+                match, suggestions = get_tactic_match(prolog, tactic_text, board, limit=SUGGESTIONS_PER_TACTIC, time_limit_sec=settings.eval_timeout, use_foreign_predicate=settings.fpred, interner=interner)
+                if match is None: # skip position for which we timeout
+                    continue
+                logger.debug(f'Suggestions: {suggestions}')
+                matched.append((board, move, match, suggestions))
+
+            with window_cache(cache) as eval_cache:
+                analyse_positions(engine, [(board, move, suggestions if match and suggestions else []) for board, move, match, suggestions in matched], eval_cache)
+                for board, move, match, suggestions in matched:
+                    update_metrics(metrics, engine, board, move, match, suggestions, position_evals(engine, board, move, settings, eval_cache), settings, eval_cache)
+                    pos_progress_bar.update(1)
     
     print_metrics(metrics, log_level=logging.DEBUG, tactic_text=tactic_text)
     return metrics
 
+def calc_metrics_by_position(prolog, tactic_texts: List[str], engine: chess.engine.SimpleEngine, positions: Generator[chess.Board, None, None], settings, interner: Optional[PositionInterner]=None, cache: Optional[EvalCache]=None) -> List[dict]:
+    "Calculate the metrics of every tactic in one pass over the positions, loading and analysing each position once"
+    # every tactic gets its own head predicate, so that all of them can be asserted at once
+    heads = [f'f_{k}' for k in range(len(tactic_texts))]
+    numbered_texts = [head + tactic_text[len('f'):] for head, tactic_text in zip(heads, tactic_texts)]
+    metrics_list = [new_metrics() for _ in tactic_texts]
+    for text in numbered_texts:
+        prolog.assertz(text)
+    try:
+        with tqdm(desc='Positions', unit='positions', leave=False) as pos_progress_bar:
+            # every tactic is matched in a window of positions first, so that the engine analyses all of them in one go
+            for window in windows(positions, WARM_BATCH_SIZE):
+                matched = []
+                for board, move, label in window:
+                    logger.debug(board)
+                    if interner:
+                        # the legal moves of an interned position are already asserted
+                        position = interner.intern(board)
+                    else:
+                        position = fen_to_contents(board.fen())
+                    outcomes = []
+                    with nullcontext() if settings.fpred or interner else assert_legal_moves(prolog, board):
+                        for head, tactic_text, metrics in zip(heads, tactic_texts, metrics_list):
+                            try:
+                                results = tactic_query(prolog, head, position, limit=SUGGESTIONS_PER_TACTIC, time_limit_sec=settings.eval_timeout)
+                            except PrologError as e:
+                                logger.warning(str(e))
+                                logger.warning(f'timeout after {settings.eval_timeout}s on tactic {tactic_text}')
+                                results = None
+                            match, suggestions = results_to_match(results)
+                            if match is None: # skip position for which we timeout
+                                continue
+                            logger.debug(f'Suggestions: {suggestions}')
+                            outcomes.append((metrics, match, suggestions))
+                    matched.append((board, move, outcomes))
+
+                # the engine is only asked about a position once some tactic has been tested in it
+                with window_cache(cache) as eval_cache:
+                    analyse_positions(engine, [(board, move, [suggestion for _, match, suggestions in outcomes if match and suggestions for suggestion in suggestions])
+                                               for board, move, outcomes in matched if outcomes], eval_cache)
+                    for board, move, outcomes in matched:
+                        if outcomes:
+                            evals = position_evals(engine, board, move, settings, eval_cache)
+                            for metrics, match, suggestions in outcomes:
+                                update_metrics(metrics, engine, board, move, match, suggestions, evals, settings, eval_cache)
+                        pos_progress_bar.update(1)
+    finally:
+        for text in numbered_texts:
+            prolog.retract(text)
+
+    for tactic_text, metrics in zip(tactic_texts, metrics_list):
+        print_metrics(metrics, log_level=logging.DEBUG, tactic_text=tactic_text)
+    return metrics_list
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Calculate metrics for a set of chess tactics')
     parser.add_argument('tactics_file', type=str, help='file containing list of tactics')
@@ -136,10 +253,25 @@ def parse_args():
     parser.add_argument('--data-path', dest='data_path', type=str, default='tactics/data/stats/metrics_data.csv', help='File path to which metrics should be written')
     parser.add_argument('--pos-list', dest='pos_list', type=str, help='Path to file contatining list of positions to use for calculating divergence')
     parser.add_argument('--fpred', default=False, action='store_true', help='Use legal_move as a foreign predicate')
+    parser.add_argument('--intern-positions', default=False, action='store_true', help='Assert each position and its legal moves once under an integer ID instead of once per tactic')
+    parser.add_argument('--materialise', default=False, action='store_true', help='Precompute attacks, piece_at and behind for each position (implies --intern-positions)')
+    parser.add_argument('--successor-table', default=False, action='store_true', help='Precompute the make_move successors of each position (implies --intern-positions)')
+    parser.add_argument('--profile-bk', default=False, action='store_true', help='Profile the background knowledge predicates with the SWI-Prolog profiler and log the time spent in each')
+    parser.add_argument('--position-major', default=False, action='store_true', help='Read and analyse each position once and match every tactic in it, instead of going through the positions once per tactic')
+    parser.add_argument('--engine-workers', type=int, default=1, help='Number of engine processes to analyse positions with concurrently')
+    parser.add_argument('--eval-cache', type=str, default=None, help='SQLite file in which to keep engine analyses between runs')
+    parser.add_argument('--warm-eval-cache', default=False, action='store_true', help='Analyse the ground-truth and best moves of every position into --eval-cache before evaluating any tactic')
     parser.add_argument('--eval-timeout', type=int, default=None, help='Prolog evaluation timeout in seconds')
     parser.add_argument('--mate-score', type=int, default=2000, help='Score to use to approximate a Mate in X evaluation')
     return parser.parse_args()
 
+def get_positions(args):
+    "Read the positions to evaluate the tactics on, from the position list if one is given and otherwise from the PGN file"
+    if args.pos_list:
+        return chess_examples(args.pos_list)
+    elif args.pgn_file:
+        return positions_pgn(args.pgn_file, args.num_games, args.pos_per_game)
+
 def create_logger(log_level):
     logging.basicConfig(level=getattr(logging, log_level))
     logger = logging.getLogger(__name__)
@@ -168,10 +300,25 @@ def main():
     # Calculate metrics for each tactic
     prolog_parser = create_parser()
     prolog = get_prolog(BK_FILE, args.fpred)
+    if args.profile_bk:
+        start_bk_profile(prolog)
+    interner = None
+    if args.intern_positions or args.materialise or args.successor_table:
+        if args.fpred:
+            raise ValueError('Interned positions need legal_move/3 to be asserted, not a foreign predicate')
+        interner = PositionInterner(prolog, materialise=args.materialise, successors=args.successor_table)
     metrics_list = []
-    with get_engine(engine_path) as engine:
+    with get_engine(engine_path, args.engine_workers) as engine, ExitStack() as stack:
+        cache = None
+        if args.eval_cache:
+            cache = stack.enter_context(EvalCache(args.eval_cache, engine_identity(engine, engine_path)))
+        elif args.warm_eval_cache:
+            raise ValueError('--warm-eval-cache needs an --eval-cache file to warm')
+        if args.warm_eval_cache:
+            warm_eval_cache(engine, get_positions(args), args, cache)
         with open(args.tactics_file) as hspace_handle:
             tactics_seen = 0
+            tactic_texts = []
             with tqdm(total=args.tactics_limit, desc='Tactics', unit='tactics') as tactics_progress_bar:
                 for line in hspace_handle:
                     logger.debug(line)
@@ -188,22 +335,32 @@ def main():
                     tactic_text = parse_result_to_str(tactic)
                     logger.debug(tactic_text)
 
-                    # Get position list
-                    if args.pos_list:
-                        positions = chess_examples(args.pos_list)
-                    elif args.pgn_file:
-                        positions = positions_pgn(args.pgn_file, args.num_games, args.pos_per_game)
-                    
-                    metrics = calc_metrics(prolog, tactic_text, engine, positions, args)
-                    if metrics:
-                        metrics['tactic_text'] = tactic_text
-                        metrics_list.append(metrics)
+                    if args.position_major:
+                        # every tactic is evaluated in the same pass over the positions, once all of them are read
+                        tactic_texts.append(tactic_text)
+                    else:
+                        metrics = calc_metrics(prolog, tactic_text, engine, get_positions(args), args, interner, cache)
+                        if metrics:
+                            metrics['tactic_text'] = tactic_text
+                            metrics_list.append(metrics)
                     tactics_seen += 1
                     tactics_progress_bar.update(1)
                     if args.tactics_limit and tactics_seen >= args.tactics_limit:
                         break
 
+            if args.position_major:
+                for tactic_text, metrics in zip(tactic_texts, calc_metrics_by_position(prolog, tactic_texts, engine, get_positions(args), args, interner, cache)):
+                    metrics['tactic_text'] = tactic_text
+                    metrics_list.append(metrics)
+
+        if cache:
+            logger.info(f'% Engine analysis cache: {cache.summary()}')
+
     logger.info(f'% Calculated metrics for {tactics_seen} tactics')
+    if args.fpred:
+        logger.info(f'% legal_move cache: {legal_move_cache.cache_info()}')
+    if args.profile_bk:
+        logger.info(f'% bk profile:\n{format_bk_profile(bk_profile(prolog))}')
     write_metrics(metrics_list, args.data_path)
 
 if __name__ == '__main__':
@@ -1,8 +1,13 @@
+import asyncio
 import csv
+import json
 import logging
 import os
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
-from typing import Generator, List, Optional, Tuple, Union
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 import chess
 import chess.engine
@@ -22,21 +27,87 @@ MAIA_1900 = os.path.join('tactics', 'bin', 'maia_weights', 'maia-1900.pb')
 STOCKFISH = os.path.join('tactics', 'bin', 'stockfish_14_x64')
 LC0 = os.path.join('tactics', 'bin', 'lc0', 'build', 'release', 'lc0')
 
+LEGAL_MOVE_CACHE_SIZE = 4096
+EVAL_CACHE_COMMIT_EVERY = 100
+
 logger = logging.getLogger(__name__)
 
 def get_lc0_cmd(lc0_path: str, weights_path: str) -> List[str]:
     return [lc0_path, f'--weights={weights_path}']
 
+class EnginePool:
+    "Several engine processes, driven through python-chess's asyncio API from a background thread, that analyse positions concurrently"
+    def __init__(self, engine_path: PathLike, workers: int):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.engines = []
+        try:
+            self.run(self.start(engine_path, workers))
+        except BaseException:
+            # an engine that fails to start leaves the ones before it running, and the loop's thread waiting
+            self.close()
+            raise
+        self.id = self.engines[0].id
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def start(self, engine_path: PathLike, workers: int) -> None:
+        self.idle = asyncio.Queue()
+        for _ in range(workers):
+            _, engine = await chess.engine.popen_uci(engine_path)
+            self.engines.append(engine)
+            self.idle.put_nowait(engine)
+
+    async def analyse_one(self, board: chess.Board, limit: chess.engine.Limit, multipv: Optional[int]):
+        engine = await self.idle.get()
+        try:
+            return await engine.analyse(board, limit, multipv=multipv, game=object())
+        finally:
+            self.idle.put_nowait(engine)
+
+    async def gather(self, requests: List[tuple]) -> list:
+        return await asyncio.gather(*(self.analyse_one(*request) for request in requests))
+
+    def analyse_many(self, requests: List[Tuple[chess.Board, chess.engine.Limit, Optional[int]]]) -> list:
+        "Analyse (board, limit, multipv) requests on whichever engines are free, and return the results in the order of the requests"
+        # the boards are copied, since they are read from the event loop's thread
+        return self.run(self.gather([(board.copy(), limit, multipv) for board, limit, multipv in requests]))
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, multipv: Optional[int]=None, game: object=None):
+        "Analyse one position like SimpleEngine.analyse, so that a pool can stand in for a single engine"
+        return self.analyse_many([(board, limit, multipv)])[0]
+
+    async def stop(self) -> None:
+        for engine in self.engines:
+            await engine.quit()
+
+    def close(self) -> None:
+        self.run(self.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+def analyse_many(engine: Union[chess.engine.SimpleEngine, EnginePool], requests: List[Tuple[chess.Board, chess.engine.Limit, Optional[int]]]) -> list:
+    "Analyse (board, limit, multipv) requests, concurrently if the engine is a pool"
+    if isinstance(engine, EnginePool):
+        return engine.analyse_many(requests)
+    return [engine.analyse(board, limit, multipv=multipv, game=object()) for board, limit, multipv in requests] # https://stackoverflow.com/a/66251120
+
 @contextmanager
-def get_engine(engine_path: PathLike):
+def get_engine(engine_path: PathLike, workers: int=1):
+    engine = None
     try:
-        engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+        engine = EnginePool(engine_path, workers) if workers > 1 else chess.engine.SimpleEngine.popen_uci(engine_path)
         yield engine
     except chess.engine.EngineError as e:
         logger.warning(str(e))
         pass
     finally:
-        engine.close()
+        # starting the engine may itself have failed
+        if engine is not None:
+            engine.close()
 
 def side_to_str(side: bool) -> str:
     return 'white' if side == chess.WHITE else 'black'
@@ -49,6 +120,15 @@ def fen_to_contents(fen: str) -> str:
 
     board = chess.Board()
     board.set_fen(fen)
+    return board_to_contents(board)
+
+# the castling predicates of a contents list, by the rook square of each castling right
+CASTLING_PREDICATES = [(chess.BB_H1, 'kingside_castle(white)'), (chess.BB_A1, 'queenside_castle(white)'),
+                       (chess.BB_H8, 'kingside_castle(black)'), (chess.BB_A8, 'queenside_castle(black)')]
+
+def board_to_contents(board: chess.Board, set_castling_rights: bool=False) -> str:
+    "Convert a board into a contents predicate, with the castling rights its pieces allow, or all the ones set on it"
+
     board_str_list = []
     for square in chess.SQUARES:
         piece = board.piece_at(square)
@@ -64,15 +144,39 @@ def fen_to_contents(fen: str) -> str:
     board_str_list.append(turn_pred)
 
     castling_preds = []
-    for side, side_str in zip([chess.WHITE, chess.BLACK], ['white', 'black']):
-        if board.has_kingside_castling_rights(side):
-            castling_preds.append(f'kingside_castle({side_str})')
-        if board.has_queenside_castling_rights(side):
-            castling_preds.append(f'queenside_castle({side_str})')
+    if set_castling_rights:
+        castling_preds = [pred for rook_square, pred in CASTLING_PREDICATES if board.castling_rights & rook_square]
+    else:
+        for side, side_str in zip([chess.WHITE, chess.BLACK], ['white', 'black']):
+            if board.has_kingside_castling_rights(side):
+                castling_preds.append(f'kingside_castle({side_str})')
+            if board.has_queenside_castling_rights(side):
+                castling_preds.append(f'queenside_castle({side_str})')
     board_str_list.extend(castling_preds)
 
     return f'[{", ".join(board_str_list)}]'
 
+# the order of the bitboards in a board/14 position, after the turn and castling rights
+BITBOARD_PIECES = [(color, piece_type) for color in chess.COLORS for piece_type in chess.PIECE_TYPES]
+# the bit of each castling right in a board/14 position
+CASTLING_BITS = [(chess.WHITE, chess.BB_H1), (chess.WHITE, chess.BB_A1), (chess.BLACK, chess.BB_H8), (chess.BLACK, chess.BB_A8)]
+
+def to_int64(bb: int) -> int:
+    "Reinterpret an unsigned 64-bit bitboard as signed, so that it fits a C long"
+    return bb - (1 << 64) if bb >= 1 << 63 else bb
+
+def fen_to_bitboards(fen: str) -> str:
+    "Convert a FEN position into a board/14 term of turn, castling rights and one bitboard per side and piece"
+
+    board = chess.Board()
+    board.set_fen(fen)
+    castling = 0
+    for bit, (side, rook_square) in enumerate(CASTLING_BITS):
+        if board.castling_rights & rook_square:
+            castling |= 1 << bit
+    bitboards = [str(to_int64(board.pieces_mask(piece_type, color))) for color, piece_type in BITBOARD_PIECES]
+    return f'board({side_to_str(board.turn)}, {castling}, {", ".join(bitboards)})'
+
 def positions_pgn(pgn_file: PathLike, num_games: int=10, pos_per_game: int=10) -> Generator[chess.Board, None, None]:
     "Generator to yield list of positions from games in a PGN file"
     with open(pgn_file) as pgn_file_handle:
@@ -109,34 +213,146 @@ def chess_examples(chess_exs_path: PathLike) -> Generator[Tuple[chess.Board, che
             label = bool(int(row['label']))
             yield (board, move, label)
 
-def get_evals(engine: chess.engine.SimpleEngine, board: chess.Board, suggestions: List[chess.Move], mate_score: int=2000) -> List[Tuple[chess.Move, int]]:
-    "Obtain engine evaluations for a list of moves in a given position"
+def engine_identity(engine: chess.engine.SimpleEngine, engine_path: PathLike) -> str:
+    "Identify an engine by its name and command line, which includes the weights of an lc0 network"
+    command = engine_path if isinstance(engine_path, str) else ' '.join(engine_path)
+    return f"{engine.id.get('name', '')} {command}"
+
+class EvalCache:
+    "An SQLite table of engine analyses, keyed by engine, search limit and position, that persists between runs"
+    def __init__(self, path: PathLike, engine_id: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS analysis (engine TEXT, search_limit TEXT, epd TEXT, result TEXT, PRIMARY KEY (engine, search_limit, epd))')
+        self.engine_id = engine_id
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, search_limit: str, board: chess.Board) -> Tuple[bool, object]:
+        "Look up an analysis, returning whether it was found and the JSON value stored for it"
+        row = self.conn.execute('SELECT result FROM analysis WHERE engine = ? AND search_limit = ? AND epd = ?', (self.engine_id, search_limit, board.epd())).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, json.loads(row[0])
+
+    def put(self, search_limit: str, board: chess.Board, result: object) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?)', (self.engine_id, search_limit, board.epd(), json.dumps(result)))
+        self.uncommitted += 1
+        if self.uncommitted >= EVAL_CACHE_COMMIT_EVERY:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        return f'{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)'
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+def decode_score(result: Optional[list]) -> Optional[chess.engine.PovScore]:
+    # stored from white's point of view, as centipawns or moves to mate
+    if result is None:
+        return None
+    cp, mate = result
+    return chess.engine.PovScore(chess.engine.Cp(cp) if mate is None else chess.engine.Mate(mate), chess.WHITE)
+
+def encode_score(score: Optional[chess.engine.PovScore]) -> Optional[list]:
+    return None if score is None else [score.white().score(), score.white().mate()]
+
+def get_scores(engine: Union[chess.engine.SimpleEngine, EnginePool], boards: List[chess.Board], cache: Optional[EvalCache]=None) -> List[Optional[chess.engine.PovScore]]:
+    "Get the engine's scores of positions after one-node searches, or None for those without a principal variation, in one batch of analyses"
+
+    scores = [None] * len(boards)
+    # the indices of the boards to analyse, by the analysis that they need
+    missing = {}
+    for i, board in enumerate(boards):
+        if cache is not None:
+            found, result = cache.get('nodes=1', board)
+            if found:
+                scores[i] = decode_score(result)
+                continue
+            # a cached position is analysed once, however often it occurs in the batch
+            key = board.epd()
+        else:
+            key = i
+        missing.setdefault(key, []).append(i)
+
+    # a cached analysis is keyed by the position alone, so it must not depend on the moves that led to it
+    analysed = [boards[indices[0]].copy(stack=False) if cache is not None else boards[indices[0]] for indices in missing.values()]
+    analyses = analyse_many(engine, [(board, chess.engine.Limit(nodes=1), None) for board in analysed])
+    for indices, analysis in zip(missing.values(), analyses):
+        score = analysis['score'] if 'pv' in analysis else None
+        if cache is not None:
+            cache.put('nodes=1', boards[indices[0]], encode_score(score))
+        for i in indices:
+            scores[i] = score
+    return scores
+
+def evaluate_moves(engine: Union[chess.engine.SimpleEngine, EnginePool], board: chess.Board, moves: List[chess.Move], mate_score: int=2000, cache: Optional[EvalCache]=None) -> List[Tuple[chess.Move, int]]:
+    "Evaluate moves in a position by how much each changes the engine's score of it, analysing the position and the positions after the moves in one batch"
+
+    tmp_boards = []
+    for move in moves:
+        tmp_board = board.copy(stack=False)
+        tmp_board.push(move)
+        tmp_boards.append((tmp_board, tmp_board.outcome()))
+    # a move that ends the game is scored without the engine, and the position itself is only analysed if some move does not
+    ongoing = [tmp_board for tmp_board, outcome in tmp_boards if outcome is None]
+    scores = get_scores(engine, [board] + ongoing, cache) if ongoing else [None]
+    prev_eval = scores[0]
+    curr_evals = iter(scores[1:])
 
     evals = []
-    for move in suggestions:
-        tmp_board = chess.Board(board.fen())
-        tmp_board.push(move)
-        if tmp_board.outcome() is not None:
+    for move, (tmp_board, outcome) in zip(moves, tmp_boards):
+        if outcome is not None:
             move_score = mate_score if tmp_board.is_checkmate() else 0
             evals.append((move, move_score))
             continue
-        prev_eval = engine.analyse(board, limit=chess.engine.Limit(nodes=1), game=object()) # https://stackoverflow.com/a/66251120
-        curr_eval = engine.analyse(tmp_board, limit=chess.engine.Limit(nodes=1), game=object())
-        orig_turn = board.turn
-        if 'pv' in prev_eval and 'pv' in curr_eval:
-            prev_score = prev_eval['score'].pov(orig_turn)
-            curr_score = curr_eval['score'].pov(orig_turn)
+        curr_eval = next(curr_evals)
+        if prev_eval is not None and curr_eval is not None:
+            prev_score = prev_eval.pov(board.turn)
+            curr_score = curr_eval.pov(board.turn)
             move_score = curr_score.score(mate_score=mate_score) - prev_score.score(mate_score=mate_score)
             evals.append((move, move_score))
     return evals
 
-def get_top_n_moves(engine: chess.engine.SimpleEngine, board: chess.Board, n: int) -> List[chess.Move]:
+def get_top_n_moves_many(engine: Union[chess.engine.SimpleEngine, EnginePool], boards: List[chess.Board], n: int, cache: Optional[EvalCache]=None) -> List[List[chess.Move]]:
+    "Get the top-n engine-recommended (and evaluated) moves for several positions in one batch of analyses"
+
+    search_limit = f'depth=1 multipv={n}'
+    top_moves = [None] * len(boards)
+    missing = []
+    for i, board in enumerate(boards):
+        if cache is not None:
+            found, result = cache.get(search_limit, board)
+            if found:
+                top_moves[i] = [chess.Move.from_uci(uci) for uci in result]
+                continue
+        missing.append(i)
+
+    # as in get_scores, a cached analysis must not depend on the moves that led to the position
+    analysed = [boards[i].copy(stack=False) if cache is not None else boards[i] for i in missing]
+    analyses = analyse_many(engine, [(board, chess.engine.Limit(depth=1), n) for board in analysed])
+    for i, analysis in zip(missing, analyses):
+        top_results = [root['pv'][0] for root in analysis]
+        top_moves[i] = top_results[:n]
+        if cache is not None:
+            cache.put(search_limit, boards[i], [move.uci() for move in top_moves[i]])
+    return top_moves
+
+def get_top_n_moves(engine: Union[chess.engine.SimpleEngine, EnginePool], board: chess.Board, n: int, cache: Optional[EvalCache]=None) -> List[chess.Move]:
     "Get the top-n engine-recommended (and evaluated) moves for a given position"
-
-    analysis = engine.analyse(board, limit=chess.engine.Limit(depth=1), multipv=n, game=object())
-    top_results = [root['pv'][0] for root in analysis]
-    top_n_results = top_results[:n]
-    return top_n_results
+    return get_top_n_moves_many(engine, [board], n, cache)[0]
 
 def parse_piece(name: str) -> int:
     name = name.lower()
@@ -154,9 +370,25 @@ def parse_piece(name: str) -> int:
         ret_val = chess.KING
     return ret_val
 
-def convert_pos_to_board(pos: List[pyswip.easy.Functor]) -> chess.Board:
+def bitboards_to_board(pos: pyswip.easy.Functor) -> chess.Board:
+    "Convert a board/14 term into a board that can be used to generate legal moves"
+
+    board = chess.Board(None)
+    turn, castling, *bitboards = [getattr(arg, 'value', arg) for arg in pos.args]
+    board.turn = str_to_side(turn)
+    for bit, (_, rook_square) in enumerate(CASTLING_BITS):
+        if castling >> bit & 1:
+            board.castling_rights |= rook_square
+    for (color, piece_type), bb in zip(BITBOARD_PIECES, bitboards):
+        for square in chess.scan_forward(bb & chess.BB_ALL):
+            board.set_piece_at(square, chess.Piece(piece_type, color))
+    return board
+
+def convert_pos_to_board(pos: Union[List[pyswip.easy.Functor], pyswip.easy.Functor]) -> chess.Board:
     "Convert a list of contents/4 predicates into a board that can be used to generate legal moves"
 
+    if isinstance(pos, pyswip.easy.Functor):
+        return bitboards_to_board(pos)
     board = chess.Board(None)
     for predicate in pos:
         predicate_name = predicate.name.value
@@ -185,15 +417,54 @@ def convert_pos_to_board(pos: List[pyswip.easy.Functor]) -> chess.Board:
             logger.error(f'Unknown predicate in position list: {predicate_name}')
     return board
 
+def position_key(pos: Union[List[pyswip.easy.Functor], pyswip.easy.Functor]) -> tuple:
+    "A hashable key for a list of contents/4, turn/1 and castling predicates, or a board/14 term"
+    if isinstance(pos, pyswip.easy.Functor):
+        return tuple(getattr(arg, 'value', arg) for arg in pos.args)
+    return tuple((predicate.name.value,) + tuple(getattr(arg, 'value', arg) for arg in predicate.args) for predicate in pos)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class LegalMoveCache:
+    "A bounded LRU cache from a position key to the decoded board and its legal moves"
+    def __init__(self, maxsize: int=LEGAL_MOVE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pos: Union[List[pyswip.easy.Functor], pyswip.easy.Functor]) -> Tuple[chess.Board, List[chess.Move]]:
+        key = position_key(pos)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        board = convert_pos_to_board(pos)
+        entry = (board, list(board.legal_moves))
+        self.entries[key] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+legal_move_cache = LegalMoveCache()
+
 # https://stackoverflow.com/a/63156085
 def legal_move(_from, to, pos, handle):
     "Implementation of a foreign predicate which unifies with legal moves in the position"
     control = pyswip.core.PL_foreign_control(handle)
 
+    if control == pyswip.core.PL_PRUNED:  # A cut has destroyed the choice point
+        return False
+
     index = None
     return_value = False
-    board = convert_pos_to_board(pos)
-    legal_moves = list(board.legal_moves)
+    # every redo is a new call, so the board and its moves come from the cache instead of being rebuilt
+    board, legal_moves = legal_move_cache.get(pos)
 
     if control == pyswip.core.PL_FIRST_CALL: # First call of legal_move
         index = 0
@@ -202,9 +473,6 @@ def legal_move(_from, to, pos, handle):
         last_index = pyswip.core.PL_foreign_context(handle)  # retrieve the index of the last call
         index = last_index + 1
 
-    if control == pyswip.core.PL_PRUNED:  # A cut has destroyed the choice point
-        return False
-        
     if isinstance(_from, pyswip.easy.Variable):
         if 0 <= index < len(legal_moves):
             move = legal_moves[index]
@@ -229,58 +497,193 @@ def get_prolog(bk_path: PathLike=None, use_foreign_predicate: bool=False) -> pys
         prolog.consult(bk_path)
     return prolog
 
+BK_PROFILE_QUERY = ('profile_data(Data), get_dict(summary, Data, Summary), get_dict(ticks, Summary, AllTicks), get_dict(time, Summary, Time), '
+                    'get_dict(nodes, Data, Nodes), member(Node, Nodes), get_dict(predicate, Node, user:Pred), '
+                    '(Pred = Name/Arity -> true ; functor(Pred, Name, Arity)), '
+                    'get_dict(call, Node, Calls), get_dict(redo, Node, Redos), get_dict(ticks_self, Node, Ticks), get_dict(ticks_siblings, Node, ChildTicks)')
+
+def start_bk_profile(prolog: pyswip.prolog.Prolog) -> None:
+    "Start SWI-Prolog's sampling profiler, which then runs under every query until the process exits"
+    list(prolog.query('profiler(_, cputime)'))
+
+def bk_profile(prolog: pyswip.prolog.Prolog) -> Dict[str, List[float]]:
+    "Map each predicate of the user module to its calls, redos, and the seconds spent in it alone and together with its callees"
+    profile = {}
+    for result in prolog.query(BK_PROFILE_QUERY):
+        # the profiler samples in ticks, which share out the sampled time between them
+        tick = result['Time'] / result['AllTicks'] if result['AllTicks'] else 0.0
+        profile[f"{result['Name']}/{result['Arity']}"] = [result['Calls'], result['Redos'], result['Ticks'] * tick, (result['Ticks'] + result['ChildTicks']) * tick]
+    return profile
+
+def merge_bk_profiles(profile: Dict[str, List[float]], other: Dict[str, List[float]]) -> None:
+    "Add the counts and times of one profile to another"
+    for pred, values in other.items():
+        profile[pred] = [a + b for a, b in zip(profile.get(pred, [0, 0, 0.0, 0.0]), values)]
+
+def format_bk_profile(profile: Dict[str, List[float]]) -> str:
+    "Render a profile as a table, the predicates that took longest first"
+    lines = [f'{"Predicate":<24}{"Calls":>12}{"Redos":>12}{"Self (s)":>12}{"Total (s)":>12}']
+    for pred, (calls, redos, self_time, total_time) in sorted(profile.items(), key=lambda item: -item[1][2]):
+        lines.append(f'{pred:<24}{calls:>12}{redos:>12}{self_time:>12.3f}{total_time:>12.3f}')
+    return '\n'.join(lines)
+
+def legal_move_facts(board: chess.Board, position: Optional[str]=None) -> List[str]:
+    "List the legal_move/3 facts for a position, rendering the position from the board if it is not given"
+    if position is None:
+        position = fen_to_contents(board.fen())
+    facts = []
+    for legal_move in board.legal_moves:
+        legal_from_sq = chess.square_name(legal_move.from_square)
+        legal_to_sq = chess.square_name(legal_move.to_square)
+        facts.append(f'legal_move({legal_from_sq}, {legal_to_sq}, {position})')
+    return facts
+
 @contextmanager
-def assert_legal_moves(prolog: pyswip.prolog.Prolog, board: chess.Board):
-    position = fen_to_contents(board.fen())
+def assert_legal_moves(prolog: pyswip.prolog.Prolog, board: chess.Board, facts: Optional[List[str]]=None):
+    if facts is None:
+        facts = legal_move_facts(board)
     try:
-        for legal_move in board.legal_moves:
-            legal_from_sq = chess.square_name(legal_move.from_square)
-            legal_to_sq = chess.square_name(legal_move.to_square)
-            legal_move_pred = f'legal_move({legal_from_sq}, {legal_to_sq}, {position})'
+        for legal_move_pred in facts:
             logger.debug(f'Asserting legal_move {legal_move_pred}')
             prolog.assertz(legal_move_pred)
         yield
     finally:
         prolog.retractall('legal_move(_, _, _)')
 
-def chess_query(prolog: pyswip.prolog.Prolog, tactic_text: str, board: chess.Board, limit: int=3, move: Optional[chess.Move]=None, time_limit_sec: Optional[int]=None, use_foreign_predicate: bool=False) -> Optional[list]:
+def to_coords_order(square: chess.Square) -> Tuple[int, int]:
+    "The order in which to_coords/3 in bk.pl enumerates squares: a1, a2, ..., a8, b1, ..."
+    return (chess.square_file(square), chess.square_rank(square))
+
+def materialised_facts(pos_id: int, board: chess.Board) -> List[str]:
+    "Precompute the attacks/3, piece_at/4 and behind/4 facts of a position, in the order and with the multiplicity the bk.pl rules find them"
+    facts = [f'materialised({pos_id})']
+    squares = sorted(chess.SQUARES, key=to_coords_order)
+    for square in squares:
+        piece = board.piece_at(square)
+        if piece:
+            facts.append(f'materialised_piece_at({pos_id}, {chess.square_name(square)}, {side_to_str(piece.color)}, {chess.piece_name(piece.piece_type)})')
+
+    # one entry per legal move, so that promotions give as many solutions as their legal_move/3 facts do
+    attacked = {square: [] for square in squares}
+    for legal_move in sorted(board.legal_moves, key=lambda move: (to_coords_order(move.from_square), to_coords_order(move.to_square))):
+        piece = board.piece_at(legal_move.from_square)
+        target = board.piece_at(legal_move.to_square)
+        if target and target.color != piece.color:
+            attacked[legal_move.from_square].append(legal_move.to_square)
+    for front in squares:
+        for target in attacked[front]:
+            facts.append(f'materialised_attacks({pos_id}, {chess.square_name(front)}, {chess.square_name(target)})')
+    for front in squares:
+        piece = board.piece_at(front)
+        if not piece or piece.piece_type not in (chess.BISHOP, chess.ROOK, chess.QUEEN):
+            continue
+        for middle in attacked[front]:
+            for back in attacked[front]:
+                facts.append(f'materialised_behind({pos_id}, {chess.square_name(front)}, {chess.square_name(middle)}, {chess.square_name(back)})')
+    return facts
+
+def successor(board: chess.Board, move: chess.Move) -> chess.Board:
+    "The position after a move as make_move/4 in bk.pl builds it: the piece moves and whatever was on its target square leaves the board"
+    # unlike Board.push, a pawn is not promoted, an en passant capture leaves the pawn it takes, castling leaves the
+    # rook where it is, the mover is still to play and the castling predicates of the position are kept as they are
+    child = board.copy(stack=False)
+    child.castling_rights = board.clean_castling_rights()
+    child.ep_square = None
+    child.set_piece_at(move.to_square, child.remove_piece_at(move.from_square))
+    return child
+
+class PositionInterner:
+    "Asserts each distinct position once under an integer ID, together with its legal moves, for the whole run"
+    def __init__(self, prolog: pyswip.prolog.Prolog, materialise: bool=False, successors: bool=False):
+        self.prolog = prolog
+        self.materialise = materialise
+        self.successors = successors
+        self.ids = {}
+        self.expanded = set()
+        # contents list -> the ID of a successor position, which has IDs of its own
+        self.successor_positions = {}
+        # (position, move) -> the ID of the position after the move
+        self.successor_ids = {}
+        prolog.assertz('legal_move(From, To, Pos) :- integer(Pos), interned_legal_move(Pos, From, To)')
+
+    def next_id(self) -> int:
+        return len(self.ids) + len(self.successor_positions)
+
+    def intern_position(self, board: chess.Board) -> int:
+        # the EPD keeps the en passant square, which changes the legal moves but not the contents list
+        key = board.epd()
+        if key not in self.ids:
+            pos_id = self.next_id()
+            self.prolog.assertz(f'interned_position({pos_id}, {fen_to_contents(board.fen())})')
+            for legal_move in board.legal_moves:
+                legal_from_sq = chess.square_name(legal_move.from_square)
+                legal_to_sq = chess.square_name(legal_move.to_square)
+                self.prolog.assertz(f'interned_legal_move({pos_id}, {legal_from_sq}, {legal_to_sq})')
+            if self.materialise:
+                for fact in materialised_facts(pos_id, board):
+                    self.prolog.assertz(fact)
+            self.ids[key] = pos_id
+        return self.ids[key]
+
+    def intern_successor(self, pos_id: int, board: chess.Board, move: chess.Move) -> int:
+        # a successor stands for the list that the make_move/4 rule would build, so it gets no legal moves or
+        # materialised relations, and never shares an ID with a position that has them
+        key = (pos_id, move)
+        if key not in self.successor_ids:
+            contents = board_to_contents(successor(board, move), set_castling_rights=True)
+            if contents not in self.successor_positions:
+                succ_id = self.next_id()
+                self.prolog.assertz(f'interned_position({succ_id}, {contents})')
+                self.successor_positions[contents] = succ_id
+            self.successor_ids[key] = self.successor_positions[contents]
+        return self.successor_ids[key]
+
+    def intern(self, board: chess.Board) -> int:
+        pos_id = self.intern_position(board)
+        # only the positions that are queried directly get a successor table, their successors use the make_move/4 rule
+        if self.successors and pos_id not in self.expanded:
+            self.expanded.add(pos_id)
+            self.prolog.assertz(f'interned_successors({pos_id})')
+            for legal_move in board.legal_moves:
+                succ_id = self.intern_successor(pos_id, board, legal_move)
+                legal_from_sq = chess.square_name(legal_move.from_square)
+                legal_to_sq = chess.square_name(legal_move.to_square)
+                self.prolog.assertz(f'interned_successor({pos_id}, {legal_from_sq}, {legal_to_sq}, {succ_id})')
+        return pos_id
+
+def tactic_query(prolog: pyswip.prolog.Prolog, head: str, position: Union[str, int], limit: int=3, move: Optional[chess.Move]=None, time_limit_sec: Optional[int]=None) -> list:
+    "Query an asserted tactic in a position whose legal moves are available, for the given move or for up to `limit` suggested moves"
+    if move:
+        from_sq = chess.square_name(move.from_square)
+        to_sq = chess.square_name(move.to_square)
+        query = f"{head}({position}, {from_sq}, {to_sq})"
+    else:
+        query = f"{head}({position}, From, To)"
+
+    if time_limit_sec:
+        query = f"call_with_time_limit({time_limit_sec}, {query})"
+        logger.debug(f'Launching query: {query} with time limit: {time_limit_sec}s')
+    else:
+        logger.debug(f'Launching query: {query} with no time limit')
+    results = list(prolog.query(f'{query}', maxresult=limit))
+    logger.debug(f'Results: {results}')
+    return results
+
+def chess_query(prolog: pyswip.prolog.Prolog, tactic_text: str, board: chess.Board, limit: int=3, move: Optional[chess.Move]=None, time_limit_sec: Optional[int]=None, use_foreign_predicate: bool=False, interner: Optional[PositionInterner]=None) -> Optional[list]:
     "Given the text of a Prolog-based tactic, and a position, check whether the tactic matched in the given position or and if so, what were the suggested moves"
-    # TODO: eek, refactor this
-    position = fen_to_contents(board.fen())
+    if interner:
+        # the legal moves of an interned position are already asserted
+        position = interner.intern(board)
+    else:
+        position = fen_to_contents(board.fen())
     try:
         prolog.assertz(tactic_text)
-        if use_foreign_predicate:
-            if move:
-                from_sq = chess.square_name(move.from_square)
-                to_sq = chess.square_name(move.to_square)
-                query = f"f({position}, {from_sq}, {to_sq})"
-            else:
-                query = f"f({position}, From, To)"
-                
-            if time_limit_sec:
-                query = f"call_with_time_limit({time_limit_sec}, {query})"
-                logger.debug(f'Launching query: {query} with time limit: {time_limit_sec}s')
-            else:
-                logger.debug(f'Launching query: {query} with no time limit')
-            results = list(prolog.query(f'{query}', maxresult=limit))
-            logger.debug(f'Results: {results}')
+        if use_foreign_predicate or interner:
+            results = tactic_query(prolog, 'f', position, limit, move, time_limit_sec)
             prolog.retract(tactic_text)
         else:
             with assert_legal_moves(prolog, board):
-                if move:
-                    from_sq = chess.square_name(move.from_square)
-                    to_sq = chess.square_name(move.to_square)
-                    query = f"f({position}, {from_sq}, {to_sq})"
-                else:
-                    query = f"f({position}, From, To)"
-                    
-                if time_limit_sec:
-                    query = f"call_with_time_limit({time_limit_sec}, {query})"
-                    logger.debug(f'Launching query: {query} with time limit: {time_limit_sec}s')
-                else:
-                    logger.debug(f'Launching query: {query} with no time limit')
-                results = list(prolog.query(f'{query}', maxresult=limit))
-                logger.debug(f'Results: {results}')
+                results = tactic_query(prolog, 'f', position, limit, move, time_limit_sec)
                 prolog.retract(tactic_text)
         return results
     except pyswip.prolog.PrologError as e:
@@ -0,0 +1,56 @@
+import random
+
+from popper.asp import ClingoGrounder
+from popper.core import ConstVar, Grounding, Literal
+
+def bindings(assignments):
+    return sorted(tuple(sorted((var.name, value) for var, value in assignment.items())) for assignment in assignments)
+
+def random_body(rng):
+    "A constraint body of the shape the constrainer builds, with clause and variable side conditions"
+    c_vars = [ConstVar(f'C{i}', 'Clause') for i in range(rng.randint(0, 3))]
+    v_vars = [ConstVar(f'V{i}', 'Variable') for i in range(rng.randint(0, 4))]
+    body = [Literal('body_literal', (c_var, 'p', 1, (v_var,))) for c_var in c_vars[:1] for v_var in v_vars]
+    if not c_vars and v_vars:
+        body = [Literal('p', tuple(v_vars))]
+    if c_vars and not v_vars:
+        body = [Literal('p', tuple(c_vars))]
+    for v_var in v_vars:
+        if rng.random() < 0.4:
+            body.append(Literal('==', (v_var, rng.randint(0, 5)), meta=True))
+    for c_var in c_vars:
+        if rng.random() < 0.4:
+            body.append(Literal('>=', (c_var, rng.randint(0, 3)), meta=True))
+    if len(c_vars) >= 2 and rng.random() < 0.5:
+        body.append(Literal('<', (c_vars[0], c_vars[1]), meta=True))
+    body.append(Literal('AllDifferent', tuple(v_vars), meta=True))
+    return body
+
+def test_native_bindings_match_clingo():
+    rng = random.Random(0)
+    grounder = ClingoGrounder()
+    checked = 0
+    while checked < 200:
+        body = random_body(rng)
+        all_vars = Grounding.find_all_vars(body)
+        if not all_vars:
+            continue
+        max_clauses, max_vars = rng.randint(1, 3), rng.randint(3, 6)
+        native = grounder.native_bindings(body, all_vars, max_clauses, max_vars)
+        assert bindings(native) == bindings(grounder.clingo_bindings(body, all_vars, max_clauses, max_vars))
+        checked += 1
+
+def test_native_bindings_leave_other_side_conditions_to_clingo():
+    c_var = ConstVar('C0', 'Clause')
+    body = [Literal('p', (c_var,)), Literal('!=', (c_var, 1), meta=True)]
+    assert ClingoGrounder().native_bindings(body, Grounding.find_all_vars(body), 3, 3) is None
+
+def test_find_bindings_caches_by_side_conditions():
+    grounder = ClingoGrounder()
+    v_var = ConstVar('V0', 'Variable')
+    body = (Literal('p', (v_var,)), Literal('AllDifferent', (v_var,), meta=True))
+    first = grounder.find_bindings((None, body), 1, 4)
+    # the same variables and side conditions with other literals are grounded the same way
+    second = grounder.find_bindings((None, (Literal('q', (v_var,)),) + body[1:]), 1, 4)
+    assert first == second and len(first) == 4
+    assert grounder.counters()['grounding cache hits'] == 1
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+try:
+    import pyswip  # noqa: F401
+except Exception as error:
+    # pyswip raises its own error, not an ImportError, when SWI-Prolog itself is missing
+    pytest.skip(f'SWI-Prolog is not available: {error}', allow_module_level=True)
+
+import chess
+
+from tactics.util import assert_legal_moves, bk_profile, fen_to_contents, format_bk_profile, get_prolog, merge_bk_profiles, start_bk_profile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BK_FILE = os.path.join(ROOT, 'chess', 'bk.pl')
+
+def profile_attacks(fen, repeat):
+    "Profile enumerating the attacks/3 answers of a position, as the tester calls the bk"
+    prolog = get_prolog(BK_FILE)
+    start_bk_profile(prolog)
+    board = chess.Board(fen)
+    position = fen_to_contents(board.fen())
+    with assert_legal_moves(prolog, board):
+        for _ in range(repeat):
+            list(prolog.query(f'findall(From-To, attacks(From, To, {position}), _)'))
+    return bk_profile(prolog)
+
+def test_bk_profile_parses_profile_data():
+    # the profiler runs until its process exits, so it gets a process of its own
+    fen = 'r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3'
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        profile = pool.submit(profile_attacks, fen, 200).result()
+
+    assert 'attacks/3' in profile
+    for pred, (calls, redos, self_time, total_time) in profile.items():
+        assert isinstance(calls, int) and isinstance(redos, int), pred
+        assert 0.0 <= self_time <= total_time + 1e-9, pred
+    assert profile['attacks/3'][0] >= 200
+
+    merged = {}
+    merge_bk_profiles(merged, profile)
+    merge_bk_profiles(merged, profile)
+    assert merged['attacks/3'][0] == 2 * profile['attacks/3'][0]
+    assert format_bk_profile(merged).splitlines()[0].startswith('Predicate')
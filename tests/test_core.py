@@ -0,0 +1,31 @@
+import random
+
+from popper.core import Clause, Literal
+
+def clause(head_args, body):
+    return (Literal('f', head_args), frozenset(Literal(pred, args) for pred, args in body))
+
+def test_canonical_form_ignores_the_names_of_body_variables():
+    first = clause(('A', 'B', 'C'), [('make_move', ('B', 'C', 'A', 'D')), ('attacks', ('C', 'E', 'D'))])
+    second = clause(('A', 'B', 'C'), [('attacks', ('C', 'X', 'Y')), ('make_move', ('B', 'C', 'A', 'Y'))])
+    assert Clause.canonical_form(first) == Clause.canonical_form(second)
+
+def test_canonical_form_keeps_the_head_variables():
+    first = clause(('A', 'B', 'C'), [('legal_move', ('B', 'C', 'A'))])
+    second = clause(('A', 'B', 'C'), [('legal_move', ('C', 'B', 'A'))])
+    assert Clause.canonical_form(first) != Clause.canonical_form(second)
+
+def test_canonical_form_tells_apart_different_sharing():
+    shared = clause(('A', 'B', 'C'), [('piece_at', ('B', 'A', 'D', 'E')), ('piece_at', ('C', 'A', 'D', 'F'))])
+    separate = clause(('A', 'B', 'C'), [('piece_at', ('B', 'A', 'D', 'E')), ('piece_at', ('C', 'A', 'F', 'G'))])
+    assert Clause.canonical_form(shared) != Clause.canonical_form(separate)
+
+def test_canonical_form_of_random_renamings():
+    rng = random.Random(0)
+    preds = [('attacks', 3), ('behind', 4), ('piece_at', 4), ('other_side', 2)]
+    names = ['D', 'E', 'F', 'G', 'H']
+    for _ in range(200):
+        body = [(pred, tuple(rng.choice(['A', 'B', 'C'] + names) for _ in range(arity))) for pred, arity in rng.sample(preds, rng.randint(1, 3))]
+        renaming = dict(zip(names, rng.sample(names, len(names))))
+        renamed = [(pred, tuple(renaming.get(arg, arg) for arg in args)) for pred, args in reversed(body)]
+        assert Clause.canonical_form(clause(('A', 'B', 'C'), body)) == Clause.canonical_form(clause(('A', 'B', 'C'), renamed))
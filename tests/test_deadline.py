@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import popper.deadline
+from popper.asp import ClingoSolver
+from popper.deadline import Deadline
+from popper.util import Settings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIAS_FILE = os.path.join(ROOT, 'chess', 'bias.pl')
+BK_FILE = os.path.join(ROOT, 'chess', 'bk.pl')
+
+BUDGET = 600.0
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(popper.deadline, 'time', lambda: now[0])
+    return now
+
+def chess_settings(**kwargs):
+    return Settings(BIAS_FILE, 'exs.csv', BK_FILE, anytime=True, split_budget=True, **kwargs)
+
+def test_chess_bias_max_size():
+    # one clause of a head and at most five body literals
+    solver = ClingoSolver(chess_settings())
+    assert (solver.max_clauses, solver.max_body, solver.max_size) == (1, 5, 6)
+
+def test_each_size_gets_its_share_of_the_chess_bias(clock):
+    settings = chess_settings()
+    settings.deadline = clock[0] + BUDGET
+    deadline = Deadline(settings, ClingoSolver(settings).max_size)
+    shares = []
+    for size in range(1, 7):
+        deadline.start_size(size)
+        shares.append(deadline.size_end - clock[0])
+        # every size uses its whole share
+        clock[0] = deadline.size_end
+    # the default --max-literals of 100 does not spread the budget over sizes that have no models
+    assert shares == pytest.approx([BUDGET / 6] * 6)
+    assert clock[0] == pytest.approx(settings.deadline)
+
+def test_unused_time_goes_to_the_next_sizes(clock):
+    settings = chess_settings()
+    settings.deadline = clock[0] + BUDGET
+    deadline = Deadline(settings, 6)
+    deadline.start_size(1)
+    # size 1 finishes at once, so sizes 2 to 6 share the whole budget
+    deadline.start_size(2)
+    assert deadline.size_end - clock[0] == pytest.approx(BUDGET / 5)
+
+def test_max_literals_below_the_bias_limit(clock):
+    settings = chess_settings(max_literals=3)
+    settings.deadline = clock[0] + BUDGET
+    deadline = Deadline(settings, 6)
+    deadline.start_size(1)
+    assert deadline.size_end - clock[0] == pytest.approx(BUDGET / 3)
+
+def test_sizes_past_the_bias_limit_get_the_time_left(clock):
+    settings = chess_settings()
+    settings.deadline = clock[0] + BUDGET
+    deadline = Deadline(settings, 6)
+    deadline.start_size(7)
+    assert deadline.size_end == pytest.approx(settings.deadline)
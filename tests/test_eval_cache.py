@@ -0,0 +1,58 @@
+import chess
+import chess.engine
+import pytest
+
+try:
+    import pyswip  # noqa: F401
+except Exception as error:
+    # pyswip raises its own error, not an ImportError, when SWI-Prolog itself is missing
+    pytest.skip(f'SWI-Prolog is not available: {error}', allow_module_level=True)
+
+from tactics.util import EvalCache, decode_score, encode_score, get_scores
+
+class FakeEngine:
+    "An engine that scores a position by its number of legal moves, and counts the positions it analyses"
+    def __init__(self):
+        self.analysed = []
+
+    def analyse(self, board, limit, multipv=None, game=None):
+        self.analysed.append(board.epd())
+        return {'score': chess.engine.PovScore(chess.engine.Cp(board.legal_moves.count()), chess.WHITE), 'pv': []}
+
+def test_put_then_get(tmp_path):
+    board = chess.Board()
+    with EvalCache(tmp_path / 'cache.db', 'engine') as cache:
+        assert cache.get('nodes=1', board) == (False, None)
+        cache.put('nodes=1', board, [12, None])
+        assert cache.get('nodes=1', board) == (True, [12, None])
+        assert (cache.hits, cache.misses) == (1, 1)
+
+def test_persists_between_runs_per_engine_and_limit(tmp_path):
+    board = chess.Board()
+    with EvalCache(tmp_path / 'cache.db', 'engine') as cache:
+        cache.put('nodes=1', board, [12, None])
+    with EvalCache(tmp_path / 'cache.db', 'engine') as cache:
+        assert cache.get('nodes=1', board) == (True, [12, None])
+        assert cache.get('depth=10', board) == (False, None)
+    with EvalCache(tmp_path / 'cache.db', 'other engine') as cache:
+        assert cache.get('nodes=1', board) == (False, None)
+
+@pytest.mark.parametrize('score', [None, chess.engine.Cp(-35), chess.engine.Mate(3), chess.engine.Mate(-2)])
+def test_encode_decode_round_trip(score):
+    pov_score = None if score is None else chess.engine.PovScore(score, chess.BLACK)
+    decoded = decode_score(encode_score(pov_score))
+    assert (decoded is None) if score is None else decoded.white() == pov_score.white()
+
+def test_get_scores_analyses_each_position_once(tmp_path):
+    board = chess.Board()
+    # the same position reached by different moves
+    transposed = chess.Board()
+    for uci in ['g1f3', 'g8f6', 'f3g1', 'f6g8']:
+        transposed.push_uci(uci)
+    engine = FakeEngine()
+    with EvalCache(tmp_path / 'cache.db', 'engine') as cache:
+        first = get_scores(engine, [board, transposed, board], cache)
+        assert engine.analysed == [board.epd()]
+        assert get_scores(engine, [transposed], cache) == first[:1]
+        assert len(engine.analysed) == 1
+    assert [score.white().score() for score in first] == [20, 20, 20]
@@ -0,0 +1,124 @@
+from types import SimpleNamespace
+
+import pytest
+
+from popper.core import Literal
+from popper.flush import ConstraintBuffer, FlushPolicy
+from popper.util import DurationAccumulator
+
+class FakeModel:
+    def __init__(self, atoms):
+        self.atoms = {str(atom) for atom in atoms}
+
+    def contains(self, symbol):
+        return str(symbol) in self.atoms
+
+def fake_stats(total_programs=0, **durations):
+    "Stats with the given total seconds for each operation, as one call each"
+    accumulators = {}
+    for operation, total in durations.items():
+        accumulators[operation] = DurationAccumulator()
+        accumulators[operation].add(total)
+    return SimpleNamespace(durations=accumulators, total_programs=total_programs)
+
+def policy(stats, flush_policy='adaptive', flush_limit=100, show_stats=False):
+    return FlushPolicy(SimpleNamespace(flush_policy=flush_policy, flush_limit=flush_limit, stats=show_stats), stats)
+
+def buffer_of(size):
+    buffer = ConstraintBuffer()
+    for i in range(size):
+        buffer.append({(None, frozenset([(True, 'p', (i,))]))})
+    return buffer
+
+def test_flushes_at_the_limit_whatever_the_policy():
+    for flush_policy in ('fixed', 'adaptive'):
+        assert policy(fake_stats(), flush_policy, flush_limit=3).should_flush(buffer_of(3))
+        assert not policy(fake_stats(), flush_policy, flush_limit=3).should_flush(buffer_of(2))
+
+def test_fixed_policy_ignores_redundant_programs():
+    flush = policy(fake_stats(total_programs=10, test=100.0, start=0.001), 'fixed')
+    flush.redundant = 50
+    assert not flush.should_flush(buffer_of(1))
+
+def test_adaptive_policy_needs_a_redundant_program():
+    flush = policy(fake_stats(total_programs=10, test=10.0, start=0.1))
+    assert not flush.should_flush(buffer_of(1))
+
+def test_first_flush_is_priced_at_the_start_of_the_search():
+    # programs cost 0.1s each to test, build and ground, and starting the search of a size took 1s
+    stats = fake_stats(total_programs=100, test=6.0, build=2.0, ground=2.0, start=1.0)
+    flush = policy(stats)
+    flush.redundant = 1
+    assert not flush.should_flush(buffer_of(1))
+    flush.redundant = 9
+    assert not flush.should_flush(buffer_of(1))
+    flush.redundant = 10
+    assert flush.should_flush(buffer_of(1))
+
+def test_first_flush_waits_for_a_timed_start():
+    flush = policy(fake_stats(total_programs=100, test=10.0))
+    flush.redundant = 1000
+    assert not flush.should_flush(buffer_of(1))
+
+def test_later_flushes_are_priced_at_the_mean_flush():
+    stats = fake_stats(total_programs=100, test=10.0, start=0.01, add=3.0, restart=1.0)
+    flush = policy(stats)
+    # two flushes took 4s together, so one costs 2s, or 20 programs
+    flush.flushes = 2
+    flush.redundant = 19
+    assert not flush.should_flush(buffer_of(1))
+    flush.redundant = 20
+    assert flush.should_flush(buffer_of(1))
+
+def program(*preds):
+    return [(Literal('f', ('A',)), frozenset(Literal(pred, ('A',)) for pred in preds))]
+
+def test_regenerated_programs_are_only_counted_with_stats():
+    flush = policy(fake_stats(), 'fixed')
+    flush.record(program('p'), FakeModel([]), ConstraintBuffer())
+    flush.flushed()
+    flush.record(program('p'), FakeModel([]), ConstraintBuffer())
+    assert flush.counters() == {'flushes': 1}
+    assert not flush.seen and not flush.previous
+
+def test_regenerated_programs_since_the_last_flush():
+    flush = policy(fake_stats(), 'fixed', show_stats=True)
+    flush.record(program('p'), FakeModel([]), ConstraintBuffer())
+    flush.record(program('q'), FakeModel([]), ConstraintBuffer())
+    flush.flushed()
+    flush.record(program('p'), FakeModel([]), ConstraintBuffer())
+    assert flush.counters()['regenerated programs'] == 1
+    flush.flushed()
+    flush.flushed()
+    # only the window before the last flush is kept
+    flush.record(program('p'), FakeModel([]), ConstraintBuffer())
+    assert flush.counters()['regenerated programs'] == 1
+    assert len(flush.seen) == 1 and not flush.previous
+
+def test_buffer_prunes_models_its_constraints_rule_out():
+    buffer = ConstraintBuffer()
+    buffer.append({(None, frozenset([(True, 'body_literal', (0, 'p', 1, (0,))), (False, 'body_literal', (0, 'q', 1, (0,)))]))})
+    assert buffer.prunes(FakeModel(['body_literal(0,p,1,(0,))']))
+    assert not buffer.prunes(FakeModel(['body_literal(0,p,1,(0,))', 'body_literal(0,q,1,(0,))']))
+    assert not buffer.prunes(FakeModel([]))
+
+def test_buffer_derives_its_own_inclusions():
+    # a constraint on an included_clause atom that only the buffered rules derive
+    buffer = ConstraintBuffer()
+    included = (True, 'included_clause', (0, 7))
+    buffer.append({(included, frozenset([(True, 'body_literal', (0, 'p', 1, (0,)))])),
+                   (None, frozenset([included, (True, 'clause', (0,))]))})
+    assert buffer.prunes(FakeModel(['body_literal(0,p,1,(0,))', 'clause(0)']))
+    assert not buffer.prunes(FakeModel(['clause(0)']))
+    # an inclusion that an earlier flush added is read from the model
+    other = ConstraintBuffer()
+    other.append({(None, frozenset([(True, 'included_clause', (0, 3))]))})
+    assert other.prunes(FakeModel(['included_clause(0,3)']))
+
+def test_banished_programs_do_not_count_towards_the_limit():
+    buffer = ConstraintBuffer()
+    buffer.banish({(None, frozenset([(True, 'p', (0,))]))})
+    assert len(buffer) == 0
+    assert buffer.prunes(FakeModel(['p(0)']))
+    buffer.clear()
+    assert not buffer.prunes(FakeModel(['p(0)']))
@@ -0,0 +1,104 @@
+import csv
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+try:
+    import pyswip  # noqa: F401
+except Exception as error:
+    # pyswip raises its own error, not an ImportError, when SWI-Prolog itself is missing
+    pytest.skip(f'SWI-Prolog is not available: {error}', allow_module_level=True)
+
+import chess
+
+from popper.asp import ClingoSolver
+from popper.chess_test import ChessTester, mask_indices
+from popper.generate import generate_program
+from popper.util import Settings, format_program
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIAS_FILE = os.path.join(ROOT, 'chess', 'bias.pl')
+BK_FILE = os.path.join(ROOT, 'chess', 'bk.pl')
+
+# castling either way, an en passant capture and promotions, which make_move/4 handles differently from python-chess
+SPECIAL_FENS = [
+    'r3k2r/pppq1ppp/8/3Pp3/8/8/PPPQ1PPP/R3K2R w KQkq e6 0 1',
+    '4k3/1P6/8/8/8/8/6p1/4K2R w K - 0 1',
+    'r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1',
+]
+
+MODES = {
+    'default': {},
+    'intern_positions': {'intern_positions': True},
+    'materialise': {'materialise': True},
+    'successor_table': {'intern_positions': True, 'successor_table': True},
+    'batch_test': {'batch_test': True},
+    'fpred': {'fpred': True},
+}
+
+def write_examples(path, seed=0, games=12, moves_per_position=3):
+    rng = random.Random(seed)
+    boards = [chess.Board(fen) for fen in SPECIAL_FENS]
+    for _ in range(games):
+        board = chess.Board()
+        for _ in range(rng.randint(5, 80)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        if any(board.legal_moves):
+            boards.append(board)
+    with open(path, 'w', newline='') as exs_file:
+        writer = csv.DictWriter(exs_file, fieldnames=['fen', 'uci', 'label'])
+        writer.writeheader()
+        for board in boards:
+            moves = list(board.legal_moves)
+            for move in rng.sample(moves, min(moves_per_position, len(moves))):
+                writer.writerow({'fen': board.fen(), 'uci': move.uci(), 'label': rng.randint(0, 1)})
+
+def hypotheses(settings, max_size=4, sample=150, seed=0):
+    "A sample of every single-clause program the bias allows up to `max_size` literals"
+    solver = ClingoSolver(settings)
+    programs = []
+    for size in range(1, max_size + 1):
+        solver.update_number_of_literals(size)
+        solver.solver.configuration.solve.models = 0
+        with solver.solver.solve(yield_ = True) as handle:
+            for model in handle:
+                programs.append(generate_program(model.symbols(shown = True))[0])
+    random.Random(seed).shuffle(programs)
+    return programs[:sample]
+
+def compare_backends(ex_file, mode):
+    "The programs on which the NumPy backend and the Prolog tester disagree, with the examples they disagree on"
+    settings = Settings(BIAS_FILE, ex_file, BK_FILE, test_backend='numpy', check_backend=True, **MODES[mode])
+    tester = ChessTester(settings)
+    ids = list(range(len(tester.examples)))
+    mismatches = []
+    try:
+        for rules in hypotheses(settings):
+            covered = tester.evaluator.coverage(rules, ids)
+            prolog_covered, skipped, evaluated = tester.prolog_coverage(rules, ids)
+            assert evaluated == tester.all_mask
+            mismatch = (covered ^ prolog_covered) & ~skipped
+            if mismatch:
+                mismatches.append((format_program(rules), list(mask_indices(mismatch))))
+    finally:
+        tester.close()
+    return mismatches
+
+@pytest.fixture(scope='module')
+def ex_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp('exs') / 'examples.csv'
+    write_examples(path)
+    return str(path)
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+def test_numpy_backend_matches_prolog(ex_file, mode):
+    # every mode asserts its own facts into the one embedded Prolog, so each runs in a fresh process
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        mismatches = pool.submit(compare_backends, ex_file, mode).result()
+    assert mismatches == []
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from popper.asp import ClingoSolver
+from popper.util import Settings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIAS_FILE = os.path.join(ROOT, 'chess', 'bias.pl')
+BK_FILE = os.path.join(ROOT, 'chess', 'bk.pl')
+
+MAX_SIZE = 4
+
+def programs(partition=None):
+    "The models of every program of the chess bias up to MAX_SIZE literals, in the given partition"
+    solver = ClingoSolver(Settings(BIAS_FILE, 'exs.csv', BK_FILE))
+    if partition:
+        solver.restrict_to_partition(*partition)
+    found = set()
+    for size in range(1, MAX_SIZE + 1):
+        solver.update_number_of_literals(size)
+        solver.solver.configuration.solve.models = 0
+        with solver.solver.solve(yield_ = True) as handle:
+            for model in handle:
+                found.add(frozenset(str(atom) for atom in model.symbols(shown = True) if atom.name == 'body_literal'))
+    return found
+
+@pytest.mark.parametrize('num_partitions', [2, 3])
+def test_partitions_split_the_hypothesis_space(num_partitions):
+    everything = programs()
+    parts = [programs((k, num_partitions)) for k in range(num_partitions)]
+    assert sum(len(part) for part in parts) == len(everything)
+    assert set().union(*parts) == everything
+    # the pairs of first two literals are dealt out in turn, so no partition is left with most of the programs
+    assert max(len(part) for part in parts) < 1.5 * len(everything) / num_partitions
@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+from popper.util import DURATION_GROWTH, DURATION_MIN, DurationAccumulator
+
+def accumulate(durations):
+    accumulator = DurationAccumulator()
+    for duration in durations:
+        accumulator.add(duration)
+    return accumulator
+
+def test_empty_accumulator():
+    accumulator = DurationAccumulator()
+    assert (accumulator.count, accumulator.total, accumulator.mean(), accumulator.quantile(0.5)) == (0, 0.0, 0.0, 0.0)
+
+def test_count_total_and_extremes():
+    accumulator = accumulate([0.5, 0.1, 2.0])
+    assert accumulator.count == 3
+    assert accumulator.total == pytest.approx(2.6)
+    assert accumulator.mean() == pytest.approx(2.6 / 3)
+    assert (accumulator.minimum, accumulator.maximum) == (0.1, 2.0)
+
+def test_quantiles_are_within_a_bucket():
+    rng = random.Random(0)
+    durations = sorted(rng.lognormvariate(-6, 2) for _ in range(10000))
+    accumulator = accumulate(durations)
+    for q in (0.5, 0.95, 0.99):
+        exact = durations[int(q * len(durations)) - 1]
+        estimate = accumulator.quantile(q)
+        if exact > DURATION_MIN:
+            assert exact / DURATION_GROWTH <= estimate <= exact * DURATION_GROWTH
+        else:
+            assert estimate <= DURATION_MIN * DURATION_GROWTH
+
+def test_quantiles_stay_within_the_extremes():
+    accumulator = accumulate([0.3] * 10)
+    assert accumulator.quantile(0.5) == accumulator.quantile(0.99) == 0.3
+
+def test_merge_is_the_same_as_adding_everything():
+    rng = random.Random(1)
+    first = [rng.expovariate(100) for _ in range(500)]
+    second = [rng.expovariate(10) for _ in range(300)]
+    merged = accumulate(first)
+    merged.merge(accumulate(second))
+    merged.merge(DurationAccumulator())
+    together = accumulate(first + second)
+    assert (merged.count, merged.minimum, merged.maximum, merged.buckets) == (together.count, together.minimum, together.maximum, together.buckets)
+    assert merged.total == pytest.approx(together.total)
+
+def test_merge_into_an_empty_accumulator():
+    merged = DurationAccumulator()
+    merged.merge(accumulate([0.2, 0.4]))
+    assert (merged.count, merged.minimum, merged.maximum) == (2, 0.2, 0.4)